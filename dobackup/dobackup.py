@@ -1,32 +1,761 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
+import fnmatch
+import functools
+import glob
+import hashlib
 import json
 import logging
 import logging.handlers
 import os.path
+import queue
+import re
+import shlex
 import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
 import sys
+import threading
 import time
-from typing import Any, List
+import urllib.parse
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 import digitalocean
 import requests
 
 from .__init__ import __basefilepath__, __version__
 
-logging.basicConfig(
-    format="%(asctime)s [%(levelname)-5.5s]  %(message)s",
-    handlers=[
+LOG_FORMAT = "%(asctime)s [%(levelname)-5.5s]  %(message)s"
+# attributes passed through 'extra=' that are copied into the json-lines log
+STRUCTURED_FIELDS = ("droplet_id", "action_id", "phase", "duration")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format each record as one json object, including any STRUCTURED_FIELDS it carries"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry, default=str)
+
+
+# the workers only put records on this queue, the listener thread does the formatting and file I/O
+log_queue = queue.Queue(-1)  # type: queue.Queue
+log_listener = None
+
+
+def setup_logging(json_log: str = None) -> logging.handlers.QueueListener:
+    # called by main(), when used as a library the application's own logging config is used
+    global log_listener
+    stop_logging()
+    if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in log.handlers):
+        log.setLevel(logging.INFO)
+        log.addHandler(logging.handlers.QueueHandler(log_queue))
+        atexit.register(stop_logging)
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [
         logging.handlers.TimedRotatingFileHandler(__basefilepath__ + "dobackup.log", when="W0", interval=2),
         logging.StreamHandler(sys.stdout),
-    ],
-    level="INFO",
-)
+    ]  # type: List[logging.Handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if json_log:
+        json_handler = logging.FileHandler(json_log)
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    return log_listener
+
+
+def stop_logging() -> None:
+    global log_listener
+    if log_listener is None:
+        return
+    log_listener.stop()  # drains the queue before returning
+    for handler in log_listener.handlers:
+        handler.close()
+    log_listener = None
+
+
+def flush_logs() -> None:
+    # wait for queued records to be written, e.g before prompting the user
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener.start()
+
+
 log = logging.getLogger()
 
 
+class Clock:
+    """Wall clock time. The workflow sleeps and reads the time only through the module's 'clock'"""
+
+    def sleep(self, seconds: float) -> None:
+        with profiler.span("sleep", "sleep", seconds=seconds):
+            time.sleep(seconds)
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now()
+
+
+class VirtualClock(Clock):
+    """Simulated time for tests, sleep() advances the clock instantly instead of waiting.
+    Each thread has its own time, so sleeps in parallel threads overlap as they would in real time, and 'elapsed'
+    is the furthest any thread got. A thread starts at that furthest time. It doesn't catch up while it waits on
+    other threads, and a reused pool thread keeps its time from its last task"""
+
+    def __init__(self, start: datetime.datetime = datetime.datetime(2020, 1, 1)) -> None:
+        self.start = start
+        self.sleeps = []  # type: List[float]
+        self._times = []  # type: List[float]  # of each thread, at the index in self._local
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self) -> float:
+        with self._lock:
+            return max(self._times, default=0.0)
+
+    def sleep(self, seconds: float) -> None:
+        with profiler.span("sleep", "sleep", seconds=seconds), self._lock:
+            self._times[self._thread_index()] += seconds
+            self.sleeps.append(seconds)
+
+    def monotonic(self) -> float:
+        with self._lock:
+            return self._times[self._thread_index()]
+
+    def now(self) -> datetime.datetime:
+        return self.start + datetime.timedelta(seconds=self.monotonic())
+
+    def _thread_index(self) -> int:
+        # with self._lock held
+        if not hasattr(self._local, "index"):
+            self._local.index = len(self._times)
+            self._times.append(max(self._times, default=0.0))
+        return self._local.index
+
+
+clock = Clock()
+
+
+def set_clock(new_clock: Clock) -> Clock:
+    # returns the clock being replaced, so it can be put back
+    global clock
+    old_clock = clock
+    clock = new_clock
+    return old_clock
+
+
+class Profiler:
+    """Records nothing. The workflow marks its spans only through the module's 'profiler'"""
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args: Any) -> Iterator[None]:
+        yield
+
+    @contextlib.contextmanager
+    def droplet(self, droplet: digitalocean.Droplet) -> Iterator[None]:
+        yield
+
+
+class TraceProfiler(Profiler):
+    """Records spans of the api requests, waits, sleeps and phases of a run, with their thread and droplet,
+    for a Chrome trace-event timeline. Open it in chrome://tracing or https://ui.perfetto.dev"""
+
+    def __init__(self) -> None:
+        self.started = clock.monotonic()
+        self.events = []  # type: List[Dict[str, Any]]
+        self.threads = {}  # type: Dict[int, str]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args: Any) -> Iterator[None]:
+        began = clock.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, category, began, clock.monotonic() - began, **args)
+
+    @contextlib.contextmanager
+    def droplet(self, droplet: digitalocean.Droplet) -> Iterator[None]:
+        # spans recorded by this thread meanwhile are attributed to 'droplet'
+        previous = getattr(self._local, "droplet", None)
+        self._local.droplet = droplet
+        try:
+            yield
+        finally:
+            self._local.droplet = previous
+
+    def add(self, name: str, category: str, began: float, duration: float, **args: Any) -> None:
+        droplet = getattr(self._local, "droplet", None)
+        if droplet is not None:
+            args.update(droplet_id=droplet.id, droplet_name=droplet.name)
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",  # complete event, with its duration
+            "ts": round((began - self.started) * 1e6, 1),  # microseconds
+            "dur": round(duration * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def totals(self) -> Dict[str, Tuple[int, float]]:
+        # spans and seconds by category, summed over the threads
+        totals = {}  # type: Dict[str, Tuple[int, float]]
+        for event in self.events:
+            count, seconds = totals.get(event["cat"], (0, 0.0))
+            totals[event["cat"]] = (count + 1, seconds + event["dur"] / 1e6)
+        return totals
+
+    def write(self, trace_path: str) -> None:
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in self.threads.items()
+        ]
+        metadata.append({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "dobackup"}})
+        with open(trace_path, "w") as trace_file:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, trace_file)
+
+    def report(self, trace_path: str) -> None:
+        log.info("Profile Written To {} , Open It In chrome://tracing Or https://ui.perfetto.dev".format(trace_path))
+        log.info(
+            "\n".join(
+                category.ljust(8) + "{:>6} spans {:>10.3f}s".format(count, seconds)
+                for category, (count, seconds) in sorted(self.totals().items())
+            )
+        )
+
+
+profiler = Profiler()
+
+
+def set_profiler(new_profiler: Profiler) -> Profiler:
+    # returns the profiler being replaced, so it can be put back
+    global profiler
+    old_profiler = profiler
+    profiler = new_profiler
+    return old_profiler
+
+
+def profiled(category: str, name: str = None) -> Callable:
+    # decorator, each call of the function is a span, named 'name' or after the function
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> Any:
+            with profiler.span(name or func.__name__, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Deadline:
+    """Time budget for the whole run, measured on 'clock'. 'reached' is set once it has cut anything short"""
+
+    def __init__(self, seconds: float = None) -> None:
+        self.seconds = seconds
+        self.ends_at = clock.monotonic() + seconds if seconds else None
+        self.reached = False
+
+    def remaining(self) -> float:
+        if self.ends_at is None:
+            return float("inf")
+        return self.ends_at - clock.monotonic()
+
+    def expired(self, margin: float = 0) -> bool:
+        if self.remaining() <= margin:
+            self.reached = True
+            return True
+        return False
+
+    def near(self) -> bool:
+        # too close to the deadline to start backing up another droplet
+        return self.seconds is not None and self.expired(self.seconds * DEADLINE_START_MARGIN)
+
+
+class BackupResult(NamedTuple):
+    droplet_id: int
+    droplet_name: str
+    snapshot_id: Optional[int] = None  # None if the backup failed, or its snapshot couldn't be found
+    snapshot_name: str = None
+    action_id: int = None
+    started_at: datetime.datetime = None
+    snapshot_duration: float = 0.0  # seconds, from shutting down (or starting a live snapshot) to its completion
+    downtime: float = 0.0  # seconds the droplet was powered off for the backup
+    transfers: Dict[str, bool] = None  # region: transferred
+    pruned: Dict[str, bool] = None  # old backup's snapshot id: deleted, with '--prune'
+    hook_duration: float = 0.0  # seconds spent in the pre and post snapshot hooks
+    error: str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class PruneResult(NamedTuple):
+    deleted: List[str]  # snapshot ids
+    failed: List[str]
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+class RestoreResult(NamedTuple):
+    droplet_id: int
+    snapshot_id: str = None
+    action_id: int = None
+    duration: float = 0.0
+    error: str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class ApiCounter:
+    """Counts the http requests sent to the api, by method and path e.g 'GET droplets/{id}/actions/{id}'"""
+
+    def __init__(self) -> None:
+        self.counts = collections.Counter()  # type: collections.Counter
+        self._lock = threading.Lock()
+        self._original_request = None
+
+    def install(self) -> None:
+        # every request python-digitalocean sends goes through requests.Session.request
+        counter = self
+        original_request = self._original_request = requests.Session.request
+
+        def counting_request(session: requests.Session, method: str, url: str, *args, **kwargs) -> Any:
+            counter.count(method, url)
+            return original_request(session, method, url, *args, **kwargs)
+
+        requests.Session.request = counting_request
+
+    def uninstall(self) -> None:
+        if self._original_request is not None:
+            requests.Session.request = self._original_request
+            self._original_request = None
+
+    def count(self, method: str, url: str) -> None:
+        path = urllib.parse.urlparse(url).path
+        path = re.sub(r"^/v2/", "", path).strip("/")
+        path = re.sub(r"(^|/)\d+(?=/|$)", r"\1{id}", path)
+        with self._lock:
+            self.counts[method.upper() + " " + path] += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def report(self, budget: int = None) -> None:
+        log.info("API Requests Sent : {}".format(self.total))
+        log.info("\n".join(str(count).rjust(6) + "  " + request for request, count in self.counts.most_common()))
+        if budget is not None and self.total > budget:
+            log.warning("API REQUEST BUDGET OF {} EXCEEDED, SENT {}".format(budget, self.total))
+
+
+class Hooks(NamedTuple):
+    # Commands run before and after the snapshot of each droplet in a live backup, e.g to freeze and thaw
+    # its filesystems. {name}, {id} and {ip} in them are replaced with the droplet's, other braces are left
+    # alone. They run locally, or on the droplet through 'ssh_command' if 'ssh_user' is given
+    pre: str = None
+    post: str = None
+    timeout: float = 60
+    ssh_user: str = None
+    ssh_command: str = "ssh -o BatchMode=yes -o ConnectTimeout=10 {target} {command}"
+
+
+class Shard:
+    """One of 'count' processes or hosts backing up the same tag. Each takes the droplets that consistent hashing
+    on droplet id gives it. With a shared 'directory' each droplet is claimed there as its backup starts and marked
+    done when it completes, so the unfinished droplets of shards that stopped, or stopped sending heartbeats, can be
+    taken over by the others"""
+
+    def __init__(
+        self, index: int, count: int, directory: str = None, run_id: str = None, takeover_after: float = 600
+    ) -> None:
+        if not 0 <= index < count:
+            raise ValueError("Shard index {} is not in 0..{}".format(index, count - 1))
+        self.index = index
+        self.count = count
+        self.takeover_after = takeover_after
+        self.run_dir = None
+        if directory:
+            # claims are per run, so each day's cron run starts over
+            self.run_dir = os.path.join(directory, run_id or clock.now().strftime("%Y-%m-%d"))
+            os.makedirs(os.path.join(self.run_dir, "claims"), exist_ok=True)
+        self.started = time.time()
+        self._stop_heartbeat = threading.Event()
+
+    def __str__(self) -> str:
+        return "{}/{}".format(self.index, self.count)
+
+    def owns(self, droplet: digitalocean.Droplet) -> bool:
+        return shard_owner(droplet.id, self.count) == self.index
+
+    def take(self, droplets: List[digitalocean.Droplet]) -> List[digitalocean.Droplet]:
+        # this shard's slice. Each droplet is claimed only as its backup starts, see 'claim'
+        mine = [droplet for droplet in droplets if self.owns(droplet)]
+        log.info("Shard {} Takes {} Of The {} Droplets".format(self, len(mine), len(droplets)))
+        return mine
+
+    def take_over(self, droplets: List[digitalocean.Droplet]) -> List[digitalocean.Droplet]:
+        # the droplets of shards that are down and weren't backed up, only possible with a shared directory.
+        # That is the ones the shard never started, and the ones it claimed but didn't finish
+        if self.run_dir is None:
+            return []
+        down = {}  # type: Dict[int, bool]
+        orphans = []
+        for droplet in droplets:
+            owner = shard_owner(droplet.id, self.count)
+            if owner == self.index or self.is_done(droplet.id):
+                continue
+            if owner not in down:
+                down[owner] = self.shard_is_down(owner)
+            if down[owner]:
+                orphans.append(droplet)
+        if orphans:
+            log.warning("Shard {} Takes Over {} Droplet(s) Of Shards That Are Down".format(self, len(orphans)))
+        return orphans
+
+    def claim(self, droplet: digitalocean.Droplet) -> bool:
+        # called just before the droplet's backup starts. A droplet claimed by a shard that has gone down
+        # without finishing it can be claimed once more, by the first shard to take it over
+        if self.run_dir is None:
+            return True
+        claim_path = self._claim_path(droplet.id)
+        if create_exclusive(claim_path, str(self.index)):
+            return True
+        try:
+            with open(claim_path) as claim_file:
+                owner = int(claim_file.read())
+        except ValueError:
+            return False  # still being written, so its shard is up
+        if owner == self.index or self.is_done(droplet.id) or not self.shard_is_down(owner):
+            return False
+        return create_exclusive(claim_path + ".takeover", str(self.index))
+
+    def done(self, droplet_id: int) -> None:
+        # the droplet was backed up, so it is not taken over
+        if self.run_dir is not None:
+            create_exclusive(self._claim_path(droplet_id) + ".done", str(self.index))
+
+    def is_done(self, droplet_id: int) -> bool:
+        return os.path.exists(self._claim_path(droplet_id) + ".done")
+
+    def shard_is_down(self, index: int) -> bool:
+        try:
+            with open(self._heartbeat_path(index)) as heartbeat_file:
+                heartbeat = json.load(heartbeat_file)
+        except (FileNotFoundError, ValueError):
+            # never showed up, give it 'takeover_after' seconds from when this shard started
+            return time.time() - self.started > self.takeover_after
+        return heartbeat["state"] == "stopped" or time.time() - heartbeat["updated"] > self.takeover_after
+
+    def start(self) -> None:
+        if self.run_dir is None:
+            return
+        self._beat("running")
+
+        def keep_beating() -> None:
+            while not self._stop_heartbeat.wait(SHARD_HEARTBEAT_EVERY):
+                self._beat("running")
+
+        threading.Thread(target=keep_beating, name="shard-heartbeat", daemon=True).start()
+
+    def stop(self) -> None:
+        # from now on, whatever this shard hasn't finished can be taken over
+        if self.run_dir is None:
+            return
+        self._stop_heartbeat.set()
+        self._beat("stopped")
+
+    def _beat(self, state: str) -> None:
+        heartbeat_path = self._heartbeat_path(self.index)
+        heartbeat = {"state": state, "updated": time.time(), "pid": os.getpid(), "host": socket.gethostname()}
+        with open(heartbeat_path + ".tmp", "w") as heartbeat_file:
+            json.dump(heartbeat, heartbeat_file)
+        os.replace(heartbeat_path + ".tmp", heartbeat_path)
+
+    def _claim_path(self, droplet_id: int) -> str:
+        return os.path.join(self.run_dir, "claims", str(droplet_id))
+
+    def _heartbeat_path(self, index: int) -> str:
+        return os.path.join(self.run_dir, "shard-{}.json".format(index))
+
+
+def create_exclusive(path: str, content: str) -> bool:
+    # False if the file already exists, creating it is atomic even on NFS
+    try:
+        file_fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(file_fd, "w") as new_file:
+        new_file.write(content)
+    return True
+
+
+def shard_owner(droplet_id: int, shard_count: int) -> int:
+    # the first shard point on the hash ring at or after the droplet's hash. Going from k to k+1 shards
+    # only moves about 1/(k+1) of the droplets
+    ring_keys, ring_shards = shard_ring(shard_count)
+    position = bisect.bisect_left(ring_keys, ring_hash(str(droplet_id))) % len(ring_keys)
+    return ring_shards[position]
+
+
+@functools.lru_cache(maxsize=None)
+def shard_ring(shard_count: int) -> Tuple[List[int], List[int]]:
+    points = sorted(
+        (ring_hash("shard-{}-{}".format(index, point)), index)
+        for index in range(shard_count)
+        for point in range(SHARD_RING_POINTS)
+    )
+    return [key for key, index in points], [index for key, index in points]
+
+
+def ring_hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+def parse_shard(shard_str: str) -> Tuple[int, int]:
+    # "INDEX/COUNT" e.g "0/4"
+    try:
+        index, count = (int(part) for part in shard_str.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("should be INDEX/COUNT e.g 0/4, not " + shard_str)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("INDEX should be from 0 to COUNT-1")
+    return index, count
+
+
+# points per shard on the consistent hashing ring
+SHARD_RING_POINTS = 64
+# seconds between a shard's heartbeats in '--shard-dir'
+SHARD_HEARTBEAT_EVERY = 30
+
+
+class Catalog:
+    """Local SQLite index of the account's droplet snapshots and droplets. It is kept in sync by the listings
+    dobackup fetches anyway and by the backups and deletes it makes, so questions about the backup history
+    are answered without the api"""
+
+    def __init__(self, do_token: str = None, path: str = None) -> None:
+        if path is None:
+            # one catalog per token, next to the lock files
+            token_hash = hashlib.sha256(do_token.encode()).hexdigest()[:12]
+            path = os.path.join(__basefilepath__, ".catalog-{}.sqlite".format(token_hash))
+        self.path = path
+        # also written from the wait and stage threads, one connection behind a lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(CATALOG_SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def sync_snapshots(self, snapshots: List[digitalocean.Snapshot]) -> Tuple[int, int, int]:
+        # 'snapshots' is a full listing. Only the rows that changed are written.
+        # Returns how many were added, updated and removed
+        rows = {}  # type: Dict[str, Tuple]
+        for snap in snapshots:
+            if getattr(snap, "resource_type", "droplet") == "droplet":  # not volume snapshots
+                rows[str(snap.id)] = snapshot_row(snap)
+        with self._lock, self._db:
+            known = {row[0]: row for row in self._db.execute("SELECT " + CATALOG_SNAPSHOT_COLUMNS + " FROM snapshots")}
+            changed = [row for snap_id, row in rows.items() if known.get(snap_id) != row]
+            gone = [(snap_id,) for snap_id in known if snap_id not in rows]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO snapshots (" + CATALOG_SNAPSHOT_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                changed,
+            )
+            self._db.executemany("DELETE FROM snapshots WHERE id = ?", gone)
+            self._synced("snapshots")
+        added = sum(1 for row in changed if row[0] not in known)
+        log.debug("Catalog Snapshots: {} Added, {} Updated, {} Removed".format(added, len(changed) - added, len(gone)))
+        return added, len(changed) - added, len(gone)
+
+    def sync_droplets(self, droplets: List[digitalocean.Droplet], tag_name: str = None) -> None:
+        # 'droplets' is a listing of all droplets, or of all the droplets with 'tag_name'
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO droplets (id, name) VALUES (?, ?)",
+                [(str(droplet.id), droplet.name) for droplet in droplets],
+            )
+            if tag_name is None:
+                ids = [(str(droplet.id),) for droplet in droplets]
+                self._db.execute("CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY)")
+                self._db.execute("DELETE FROM listed")
+                self._db.executemany("INSERT INTO listed (id) VALUES (?)", ids)
+                self._db.execute("DELETE FROM droplets WHERE id NOT IN (SELECT id FROM listed)")
+                self._db.execute("DELETE FROM droplet_tags WHERE droplet_id NOT IN (SELECT id FROM listed)")
+                tags = [(str(droplet.id), tag) for droplet in droplets for tag in droplet.tags]
+                self._db.executemany("INSERT OR IGNORE INTO droplet_tags (droplet_id, tag) VALUES (?, ?)", tags)
+                self._synced("droplets")
+            else:
+                self._db.execute("DELETE FROM droplet_tags WHERE tag = ?", (tag_name,))
+                self._db.executemany(
+                    "INSERT INTO droplet_tags (droplet_id, tag) VALUES (?, ?)",
+                    [(str(droplet.id), tag_name) for droplet in droplets],
+                )
+
+    def add_backup(self, droplet: digitalocean.Droplet, snapshot_id: Optional[int], snap_name: str) -> None:
+        # a backup dobackup just took, its size and regions come with the next listing. If its id couldn't be
+        # found, it is kept under a placeholder id until the next listing replaces it
+        tag_name, keep = backup_tag(snap_name)
+        if snapshot_id is None:
+            snapshot_id = "pending:{}:{}".format(droplet.id, snap_name)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots (" + CATALOG_SNAPSHOT_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(snapshot_id), snap_name, str(droplet.id), tag_name, keep, clock.now().timestamp(), None, None),
+            )
+
+    def remove_snapshot(self, snapshot_id: str) -> None:
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM snapshots WHERE id = ?", (str(snapshot_id),))
+
+    def last_synced(self, listing: str) -> float:
+        with self._lock:
+            row = self._db.execute("SELECT at FROM synced WHERE listing = ?", (listing,)).fetchone()
+        return row[0] if row else None
+
+    def latest_backups(self, tag_name: str) -> List[Tuple]:
+        # (droplet_id, droplet_name, snapshot_id, snapshot_name, created_at) of each droplet's latest backup
+        return self._query(
+            "SELECT s.droplet_id, d.name, s.id, s.name, MAX(s.created_at) FROM snapshots s"
+            " LEFT JOIN droplets d ON d.id = s.droplet_id WHERE s.tag = ? GROUP BY s.droplet_id ORDER BY d.name",
+            (tag_name,),
+        )
+
+    def not_backed_up_in(self, tag_name: str, hours: float) -> List[Tuple]:
+        # (droplet_id, droplet_name, created_at of the latest backup or None) of the droplets with 'tag_name',
+        # or with backups by 'tag_name', that have no backup newer than 'hours'
+        since = clock.now().timestamp() - hours * 60 * 60
+        return self._query(
+            "SELECT d.id, d.name, (SELECT MAX(created_at) FROM snapshots WHERE tag = ? AND droplet_id = d.id) AS latest"
+            " FROM droplets d WHERE (d.id IN (SELECT droplet_id FROM droplet_tags WHERE tag = ?)"
+            " OR d.id IN (SELECT droplet_id FROM snapshots WHERE tag = ?)) AND (latest IS NULL OR latest < ?)"
+            " ORDER BY d.name",
+            (tag_name, tag_name, tag_name, since),
+        )
+
+    def storage_per_tag(self) -> List[Tuple]:
+        # (tag, backups, gigabytes) of the backups by each '--tag-name', snapshots not taken by dobackup as None
+        return self._query(
+            "SELECT tag, COUNT(*), SUM(size_gigabytes) FROM snapshots GROUP BY tag ORDER BY SUM(size_gigabytes) DESC"
+        )
+
+    def _query(self, sql: str, parameters: Tuple = ()) -> List[Tuple]:
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def _synced(self, listing: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO synced (listing, at) VALUES (?, ?)", (listing, clock.now().timestamp())
+        )
+
+
+def snapshot_row(snap: digitalocean.Snapshot) -> Tuple:
+    tag_name, keep = backup_tag(snap.name)
+    # created_at is UTC, e.g "2018-05-02T12:37:58Z"
+    created = datetime.datetime.strptime(snap.created_at, "%Y-%m-%dT%H:%M:%SZ")
+    created_at = created.replace(tzinfo=datetime.timezone.utc).timestamp()
+    regions = ",".join(sorted(snap.regions)) if snap.regions else None
+    return (str(snap.id), snap.name, str(snap.resource_id), tag_name, keep, created_at, snap.size_gigabytes, regions)
+
+
+def backup_tag(snap_name: str) -> Tuple[str, int]:
+    # the '--tag-name' of a backup and whether it is a '--keep' backup, (None, 0) if dobackup didn't take it
+    match = BACKUP_NAME.search(snap_name)
+    if match is None:
+        return None, 0
+    return match.group("tag"), int(match.group("keep") is not None)
+
+
+catalog = None  # type: Catalog
+
+
+def set_catalog(new_catalog: Catalog) -> Catalog:
+    # returns the catalog being replaced, so it can be put back
+    global catalog
+    old_catalog = catalog
+    catalog = new_catalog
+    return old_catalog
+
+
+# droplet.name + "--dobackup--2018-05-02 12:37:52" or droplet.name + "--dobackup-keep--2018-05-02 12:37:52"
+BACKUP_NAME = re.compile(r"--(?P<tag>.+?)(?P<keep>-keep)?--(?P<date>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})$")
+CATALOG_SNAPSHOT_COLUMNS = "id, name, droplet_id, tag, keep, created_at, size_gigabytes, regions"
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    droplet_id TEXT NOT NULL,
+    tag TEXT,  -- '--tag-name' of a dobackup backup
+    keep INTEGER NOT NULL,
+    created_at REAL NOT NULL,  -- unix time
+    size_gigabytes REAL,
+    regions TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_droplet ON snapshots (droplet_id, created_at);
+CREATE INDEX IF NOT EXISTS snapshots_tag ON snapshots (tag, droplet_id, created_at);
+CREATE INDEX IF NOT EXISTS snapshots_created ON snapshots (created_at);
+CREATE TABLE IF NOT EXISTS droplets (id TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS droplet_tags (droplet_id TEXT NOT NULL, tag TEXT NOT NULL, PRIMARY KEY (droplet_id, tag));
+CREATE INDEX IF NOT EXISTS droplet_tags_tag ON droplet_tags (tag);
+CREATE TABLE IF NOT EXISTS synced (listing TEXT PRIMARY KEY, at REAL NOT NULL);
+"""
+
+# exit codes, besides 0 (all good) and 1 (something failed)
+EXIT_DEADLINE = 3  # '--deadline' was reached, some droplets were skipped or not waited for
+EXIT_LOCKED = 4  # another run with the same token and tag is still going
+
+# no new droplets are started in the last 10% of the '--deadline'
+DEADLINE_START_MARGIN = 0.1
+# a lock older than this is stale even if its process still seems to be running
+LOCK_STALE_AFTER = 24 * 60 * 60
+
+# how many times the new snapshot is looked for, 5 seconds apart, once its action completed
+FIND_SNAPSHOT_TRIES = 3
+
+# how many droplets' pre snapshot hooks run at the same time
+MAX_HOOK_WORKERS = 16
+# how many snapshot actions are waited on (and their droplets powered back up) at the same time
+MAX_WAIT_WORKERS = 8
+
+
 def parse_args(argv: List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Automated Offline Or Live Snapshots Of Digitalocean Droplets")
     parser.add_argument(
@@ -38,6 +767,12 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     )
     parser.add_argument("-v", "-V", "--version", action="version", version="dobackup " + __version__)
     parser.add_argument("--init", dest="init", help="Save token to .token file", action="store_true")
+    parser.add_argument(
+        "--log-json",
+        dest="log_json",
+        type=str,
+        help="Also write the log as json lines, with droplet_id, action_id, phase and duration fields, to this file",
+    )
 
     info_args = parser.add_argument_group("Informational Args", "Arguments That Display Information")
     info_args.add_argument("-l", "--list-droplets", dest="list_droplets", help="List all droplets", action="store_true")
@@ -82,10 +817,17 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
 
     action_args = parser.add_argument_group("Action Args", "Arguments That Perform Actions")
     action_args.add_argument(
-        "--tag-droplet", dest="tag_droplet", type=str, help="Add tag to the provided droplet name or id"
+        "--tag-droplet",
+        dest="tag_droplet",
+        type=str,
+        help="Add tag to the provided droplet(s) by name, id, glob or 're:' regex. "
+        "e.g --tag-droplet 'web-*,db-1,re:^cache-[0-9]+$'",
     )
     action_args.add_argument(
-        "--untag-droplet", dest="untag_droplet", type=str, help="Remove tag from the provided droplet name or id"
+        "--untag-droplet",
+        dest="untag_droplet",
+        type=str,
+        help="Remove tag from the provided droplet(s) by name, id, glob or 're:' regex",
     )
     parser.add_argument(
         "--tag-name",
@@ -98,6 +840,13 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     action_args.add_argument(
         "--delete-older-than", dest="delete_older_than", type=int, help="Delete backups older than, in days"
     )
+    action_args.add_argument(
+        "--prune",
+        dest="prune",
+        help='With "--delete-older-than" and a backup, delete each droplet\'s old backups as soon as its new backup '
+        "completes, while the other backups are still running",
+        action="store_true",
+    )
     action_args.add_argument(
         "--delete-snap",
         dest="delete_snap",
@@ -114,6 +863,134 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     backup_args.add_argument(
         "--restore-to", dest="restore_to", type=str, help="Snapshot id or name, to restore the droplet to"
     )
+    parser.add_argument(
+        "--deadline",
+        dest="deadline",
+        type=int,
+        help="Time budget for the run, in seconds. Near it no new droplets are started, waiting stops at it "
+        "(offline droplets are always powered back up) and the exit code is 3",
+    )
+    hook_args = parser.add_argument_group(
+        "Hook Args", 'Commands Run Around Each Snapshot Of "--live-backup" and "--live-backup-all"'
+    )
+    hook_args.add_argument(
+        "--pre-snapshot-hook",
+        dest="pre_snapshot_hook",
+        type=str,
+        help="Command run before the snapshot, e.g 'fsfreeze -f /'. {name}, {id} and {ip} are replaced "
+        "with the droplet's. If it fails the droplet is not snapshotted",
+    )
+    hook_args.add_argument(
+        "--post-snapshot-hook",
+        dest="post_snapshot_hook",
+        type=str,
+        help="Command run once the snapshot completes (or fails), e.g 'fsfreeze -u /'",
+    )
+    hook_args.add_argument(
+        "--hook-timeout", dest="hook_timeout", type=int, help="Seconds before a hook is killed, default=60", default=60
+    )
+    hook_args.add_argument(
+        "--hook-ssh",
+        dest="hook_ssh",
+        type=str,
+        help="Run the hooks on the droplets, over ssh as this user, instead of locally",
+    )
+    hook_args.add_argument(
+        "--hook-ssh-command",
+        dest="hook_ssh_command",
+        type=str,
+        help="Command used to run the hooks with \"--hook-ssh\", default='{}'. "
+        "e.g 'sh -c {{command}}' runs them locally instead, for testing".format(Hooks().ssh_command),
+        default=Hooks().ssh_command,
+    )
+    shard_args = parser.add_argument_group(
+        "Shard Args", 'Split "--backup-all" and "--live-backup-all" Between Several Processes Or Hosts'
+    )
+    shard_args.add_argument(
+        "--shard",
+        dest="shard",
+        type=parse_shard,
+        help="INDEX/COUNT, e.g '0/4'. Only back up the tagged droplets that hashing their id gives to this shard",
+    )
+    shard_args.add_argument(
+        "--shard-dir",
+        dest="shard_dir",
+        type=str,
+        help="Directory shared by all the shards, e.g on NFS. Droplets are claimed in it, and the shards take over "
+        "the droplets of shards that are down",
+    )
+    shard_args.add_argument(
+        "--shard-run-id",
+        dest="shard_run_id",
+        type=str,
+        help='Name of this run in "--shard-dir", default is today\'s date',
+    )
+    shard_args.add_argument(
+        "--shard-takeover",
+        dest="shard_takeover",
+        type=int,
+        help="Seconds without a heartbeat before a shard is considered down, default=600",
+        default=600,
+    )
+    profile_args = parser.add_argument_group("Profile Args", "Find Out Where The Time Of A Run Goes")
+    profile_args.add_argument(
+        "--profile",
+        dest="profile",
+        type=str,
+        help="Write a timeline of the api requests, waits, sleeps and phases of each droplet to this file, "
+        "in Chrome trace-event json",
+    )
+    profile_args.add_argument(
+        "--profile-cprofile",
+        dest="profile_cprofile",
+        type=str,
+        help="Also write cProfile stats of the main thread (listing, sorting, parsing) to this file",
+    )
+    catalog_args = parser.add_argument_group(
+        "Catalog Args", "A Local Index Of The Backups, For Questions The Listings Can't Answer"
+    )
+    catalog_args.add_argument(
+        "--catalog",
+        dest="use_catalog",
+        help="Keep the local catalog up to date with the listings and backups of this run",
+        action="store_true",
+    )
+    catalog_args.add_argument(
+        "--catalog-sync",
+        dest="catalog_sync",
+        help="Bring the catalog up to date with all the snapshots and droplets of the account",
+        action="store_true",
+    )
+    catalog_args.add_argument(
+        "--latest-backups",
+        dest="latest_backups",
+        help='The latest backup of each droplet, using "--tag-name"',
+        action="store_true",
+    )
+    catalog_args.add_argument(
+        "--not-backed-up-in",
+        dest="not_backed_up_in",
+        type=float,
+        help='Droplets with "--tag-name" and no backup in this many hours, exits with code 1 if there are any',
+    )
+    catalog_args.add_argument(
+        "--backup-storage",
+        dest="backup_storage",
+        help="Number and size of the backups, per tag",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--api-stats",
+        dest="api_stats",
+        help="Show how many api requests were sent, per request type, at the end",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--api-budget",
+        dest="api_budget",
+        type=int,
+        help='Warn if the run sends more api requests than this, implies "--api-stats"',
+    )
     parser.add_argument(
         "--keep",
         dest="keep",
@@ -121,6 +998,19 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     To be used with "--backup","--backup-all"',
         action="store_true",
     )
+    backup_args.add_argument(
+        "--transfer-to",
+        dest="transfer_to",
+        type=str,
+        help="Region(s) to copy each new backup to, as soon as it completes. e.g --transfer-to 'nyc3,ams3'",
+    )
+    backup_args.add_argument(
+        "--transfer-workers",
+        dest="transfer_workers",
+        type=int,
+        help='How many "--transfer-to" copies and "--prune" deletes run at the same time, default=4',
+        default=4,
+    )
 
     return parser.parse_args(argv[1:])
 
@@ -148,7 +1038,37 @@ def run(
     restore_drop: str,
     restore_to: str,
     keep: bool,
+    transfer_to: str = None,
+    transfer_workers: int = 4,
+    deadline: int = None,
+    api_stats: bool = False,
+    api_budget: int = None,
+    prune: bool = False,
+    hooks: Hooks = None,
+    shard: Shard = None,
+    profile: str = None,
+    profile_cprofile: str = None,
+    use_catalog: bool = False,
+    catalog_sync: bool = False,
+    latest_backups: bool = False,
+    not_backed_up_in: float = None,
+    backup_storage: bool = False,
 ) -> int:
+    run_deadline = Deadline(deadline)
+    lock_path = None
+    run_catalog = old_catalog = None
+    trace_profiler = old_profiler = None
+    if profile:
+        trace_profiler = TraceProfiler()
+        old_profiler = set_profiler(trace_profiler)
+    cprofile = None
+    if profile_cprofile:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+    api_counter = None
+    if api_stats or api_budget is not None:
+        api_counter = ApiCounter()
+        api_counter.install()
     try:
         log.info("-------------------------START-------------------------\n")
         if init:
@@ -160,6 +1080,51 @@ def run(
         if do_token == "":
             return 1
         manager = set_manager(do_token)
+        catalog_query = latest_backups or backup_storage or not_backed_up_in is not None
+        if use_catalog or catalog_sync or catalog_query:
+            run_catalog = Catalog(do_token)
+            old_catalog = set_catalog(run_catalog)
+            if catalog_sync or (catalog_query and run_catalog.last_synced("snapshots") is None):
+                sync_catalog(manager)
+        if (
+            backup
+            or backup_all
+            or live_backup
+            or live_backup_all
+            or shutdown
+            or powerup
+            or restore_drop
+            or (delete_older_than or delete_older_than == 0)
+            or delete_snap
+            or tag_droplet
+            or untag_droplet
+        ):
+            # shards on the same host each take their own lock, but none runs alongside a plain run of the tag
+            lock_path = acquire_run_lock(do_token, tag_name + ("-shard-{}".format(shard.index) if shard else ""))
+            if lock_path is None or not shards_apart(do_token, tag_name, shard):
+                return EXIT_LOCKED
+        if shard and (backup_all or live_backup_all):
+            shard.start()
+        transfer_regions = [region.strip() for region in transfer_to.split(",")] if transfer_to else []
+        # with '--prune', old backups by droplet id, deleted as each droplet's new backup completes
+        prune_snapshots = {}  # type: Dict[str, List[digitalocean.Snapshot]]
+
+        def run_backups(droplets: List[digitalocean.Droplet], live: bool) -> bool:
+            results = backup_droplets(
+                droplets,
+                keep,
+                tag_name,
+                live,
+                transfer_regions,
+                transfer_workers,
+                deadline=run_deadline,
+                prune=prune_snapshots,
+                hooks=hooks,
+                claim=shard.claim if shard else None,
+            )
+            if shard:
+                [shard.done(result.droplet_id) for result in results if result.ok]
+            return all(result.ok for result in results)
 
         if list_droplets:
             list_all_droplets(manager)
@@ -173,23 +1138,25 @@ def run(
             log.info(tagged_droplets)
         if list_tags:
             list_all_tags(manager)
+        if latest_backups:
+            list_latest_backups(run_catalog, tag_name)
+        if backup_storage:
+            list_backup_storage(run_catalog)
         if tag_droplet:
-            droplet = find_droplet(tag_droplet, manager)
-            if droplet is None:
+            droplets = find_droplets(tag_droplet, manager)
+            if not droplets:
                 return 1
-            do_tag_droplet(do_token, str(droplet.id), tag_name)
-            tagged_droplets = get_tagged(manager, tag_name=tag_name)
-            log.info("Now, Droplets Tagged With : '{}' Are :".format(tag_name))
-            log.info(tagged_droplets)
+            do_tag_droplet(do_token, [str(droplet.id) for droplet in droplets], tag_name)
+            log.info("Now Tagged With : '{}' :".format(tag_name))
+            log.info(droplets)
         if untag_droplet:
-            droplet = find_droplet(untag_droplet, manager)
-            if droplet is None:
+            droplets = find_droplets(untag_droplet, manager)
+            if not droplets:
                 return 1
-            if do_untag_droplet(do_token, str(droplet.id), tag_name) is False:
+            if do_untag_droplet(do_token, [str(droplet.id) for droplet in droplets], tag_name) is False:
                 return 1
-            tagged_droplets = get_tagged(manager, tag_name=tag_name)
-            log.info("Now, Droplets Tagged With : '{}' Are :".format(tag_name))
-            log.info(tagged_droplets)
+            log.info("No Longer Tagged With : '{}' :".format(tag_name))
+            log.info(droplets)
         if delete_older_than or delete_older_than == 0:  # even accept value 0
             old_backups = find_old_backups(manager, delete_older_than, tag_name)
             log.info(
@@ -197,10 +1164,14 @@ def run(
                 " \n".format(delete_older_than, tag_name)
             )
             [log.info(str(x)) for x in old_backups]
-            if old_backups:  # not an empty list
-                [delete_snapshot(snap_x) for snap_x in old_backups]
-            else:
+            if not old_backups:
                 log.info("No Snapshot Is Old Enough To be Deleted")
+            elif prune and (backup or backup_all or live_backup or live_backup_all):
+                log.info("Each Will Be Deleted Once The New Backup Of Its Droplet Completes")
+                for snap_x in old_backups:
+                    prune_snapshots.setdefault(str(snap_x.resource_id), []).append(snap_x)
+            else:
+                [delete_snapshot(snap_x) for snap_x in old_backups]
         if delete_snap:
             # if multiple snaps are supplied
             if "," in delete_snap:
@@ -224,67 +1195,42 @@ def run(
             droplet = find_droplet(backup, manager)
             if droplet is None:
                 return 1
-            original_status = droplet.status  # active or off
-            turn_it_off(droplet)
-            snap_action = start_backup(droplet, keep, tag_name)
-            snap_done = snap_completed(snap_action)
-            if original_status != "off":
-                turn_it_on(droplet)
-            if not snap_done:
-                log.error("SNAPSHOT FAILED {!s} {!s}".format(snap_action, droplet))
+            if not run_backups([droplet], False):
+                return EXIT_DEADLINE if run_deadline.reached else 1
         if backup_all:
-            # stores all {"snap_action": snap_action, "droplet_id": droplet}
-            snap_and_drop_ids = []
             tagged_droplets = get_tagged(manager, tag_name=tag_name)
 
             if tagged_droplets:  # doplets found with the --tag-name
-                for drop in tagged_droplets:
-                    droplet = send_command(5, manager, "get_droplet", drop.id)
-                    original_status = droplet.status  # active or off
-                    turn_it_off(droplet)
-                    snap_action = start_backup(droplet, keep, tag_name)
-                    snap_and_drop_ids.append(
-                        {"snap_action": snap_action, "droplet_id": droplet.id, "original_status": original_status}
-                    )
-                log.info("Backups Started, snap_and_drop_ids: {!s}".format(snap_and_drop_ids))
-                for snap_id_pair in snap_and_drop_ids:
-                    snap_done = snap_completed(snap_id_pair["snap_action"])
-                    # print("snap_action and droplet_id", snap_id_pair)
-                    if snap_id_pair["original_status"] != "off":
-                        turn_it_on(send_command(5, manager, "get_droplet", (snap_id_pair["droplet_id"])))
-                    if not snap_done:
-                        log.error("SNAPSHOT FAILED {!s} {!s}".format(snap_action, droplet))
+                if not run_backups(shard.take(tagged_droplets) if shard else tagged_droplets, False):
+                    return EXIT_DEADLINE if run_deadline.reached else 1
+                if shard and not run_backups(shard.take_over(tagged_droplets), False):
+                    return EXIT_DEADLINE if run_deadline.reached else 1
             else:  # no doplets with the --tag-name
                 log.warning("NO DROPLET FOUND WITH THE TAG NAME " + tag_name)
         if live_backup:
             droplet = find_droplet(live_backup, manager)
             if droplet is None:
                 return 1
-            snap_action = start_backup(droplet, keep, tag_name)
-            snap_done = snap_completed(snap_action)
-            if not snap_done:
-                log.error("SNAPSHOT FAILED {!s} {!s}".format(snap_action, droplet))
+            if not run_backups([droplet], True):
+                return EXIT_DEADLINE if run_deadline.reached else 1
         if live_backup_all:
-            # stores all {"snap_action": snap_action, "droplet_id": droplet}
-            snap_and_drop_ids = []
             tagged_droplets = get_tagged(manager, tag_name=tag_name)
 
             if tagged_droplets:  # doplets found with the --tag-name
-                for drop in tagged_droplets:
-                    droplet = send_command(5, manager, "get_droplet", drop.id)
-                    original_status = droplet.status  # active or off
-                    snap_action = start_backup(droplet, keep, tag_name)
-                    snap_and_drop_ids.append(
-                        {"snap_action": snap_action, "droplet_id": droplet.id, "original_status": original_status}
-                    )
-                log.info("Backups Started, snap_and_drop_ids: {!s}".format(snap_and_drop_ids))
-                for snap_id_pair in snap_and_drop_ids:
-                    snap_done = snap_completed(snap_id_pair["snap_action"])
-                    # print("snap_action and droplet_id", snap_id_pair)
-                    if not snap_done:
-                        log.error("SNAPSHOT FAILED {!s} {!s}".format(snap_action, droplet))
+                if not run_backups(shard.take(tagged_droplets) if shard else tagged_droplets, True):
+                    return EXIT_DEADLINE if run_deadline.reached else 1
+                if shard and not run_backups(shard.take_over(tagged_droplets), True):
+                    return EXIT_DEADLINE if run_deadline.reached else 1
             else:  # no doplets with the --tag-name
                 log.warning("NO DROPLET FOUND WITH THE TAG NAME " + tag_name)
+        if prune_snapshots and not shard:
+            # all backups succeeded, the old backups of droplets that weren't backed up can go too
+            # (with '--shard' those belong to the other shards)
+            [delete_snapshot(snap_x) for snaps in prune_snapshots.values() for snap_x in snaps]
+        # after the backups, so it counts the ones this run just took
+        all_backed_up = True
+        if not_backed_up_in is not None:
+            all_backed_up = list_not_backed_up(run_catalog, tag_name, not_backed_up_in)
         if shutdown:
             droplet = find_droplet(shutdown, manager)
             if droplet is None:
@@ -305,14 +1251,39 @@ def run(
                 log.warning("Please Use '--restore-to' To Provide The id Of " "Snapshot To Restore This Droplet To")
 
         log.info("---------------------------END----------------------------\n\n")
+        if not all_backed_up:
+            return 1  # '--not-backed-up-in' found droplets without a recent backup
         return 0  # if all good, return 0
     except Exception as e:
         log.critical(e, exc_info=True)  # if errored at any time, mark CRITICAL and log traceback
         return 1
+    finally:
+        if shard:
+            shard.stop()
+        if lock_path:
+            release_run_lock(lock_path)
+        if api_counter is not None:
+            api_counter.uninstall()
+            api_counter.report(api_budget)
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(profile_cprofile)
+            log.info(
+                "cProfile Stats Written To {} , e.g python -m pstats {}".format(profile_cprofile, profile_cprofile)
+            )
+        if run_catalog is not None:
+            set_catalog(old_catalog)
+            run_catalog.close()
+        if trace_profiler is not None:
+            set_profiler(old_profiler)
+            trace_profiler.add("run", "run", trace_profiler.started, clock.monotonic() - trace_profiler.started)
+            trace_profiler.write(profile)
+            trace_profiler.report(profile)
 
 
 def main() -> int:
     args = parse_args(sys.argv)
+    setup_logging(args.log_json)
     return_code = run(
         args.token_id,
         args.init,
@@ -336,6 +1307,21 @@ def main() -> int:
         args.restore_drop,
         args.restore_to,
         args.keep,
+        args.transfer_to,
+        args.transfer_workers,
+        args.deadline,
+        args.api_stats,
+        args.api_budget,
+        args.prune,
+        Hooks(args.pre_snapshot_hook, args.post_snapshot_hook, args.hook_timeout, args.hook_ssh, args.hook_ssh_command),
+        Shard(*args.shard, args.shard_dir, args.shard_run_id, args.shard_takeover) if args.shard else None,
+        args.profile,
+        args.profile_cprofile,
+        args.use_catalog,
+        args.catalog_sync,
+        args.latest_backups,
+        args.not_backed_up_in,
+        args.backup_storage,
     )
     return return_code
 
@@ -346,6 +1332,7 @@ def set_tokens() -> bool:
     print("Press enter after pasting each token.")
     print("When you have pasted all tokens you have, press another enter (leave field empty)")
     for i in range(5):
+        flush_logs()  # so the log lines, e.g the length error, appear before the prompt
         token_str = input("Paste The Digital Ocean's Token to Be Stored In .token File : ")
         if token_str == "":
             break
@@ -380,40 +1367,43 @@ def install_zsh_completion() -> None:
         log.info("Zsh-completions with oh-my-zsh is not installed, can't use auto completions, but that's ok")
 
 
-def wait_for_action(an_action: digitalocean.Action, check_freq: int) -> bool:
+def wait_for_action(
+    an_action: digitalocean.Action, check_freq: int, repeat: int = 20, deadline: Deadline = None
+) -> bool:
     for i in range(50):
         try:
-            snap_outcome = an_action.wait(update_every_seconds=check_freq)
+            with profiler.span("wait_for_action", "wait", action_id=an_action.id):
+                snap_outcome = poll_action(an_action, check_freq, repeat, deadline)
         except requests.exceptions.RequestException:
             log.warning("'requests' reported error, TRYING AGAIN")
             # Excepts
             # requests.exceptions.SSLError: HTTPSConnectionPool
             # (host='api.digitalocean.com', port=443): Max retries exceeded with url:
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except json.decoder.JSONDecodeError:
             log.warning("json.decoder.JSONDecodeError HAPPENED BUT IT'S FINE, TRYING AGAIN")
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except digitalocean.baseapi.JSONReadError:
             log.warning("json.decoder.JSONReadError HAPPENED BUT IT'S FINE, TRYING AGAIN")
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except digitalocean.baseapi.DataReadError:
             log.warning("json.decoder.DataReadError HAPPENED BUT IT'S FINE, TRYING AGAIN")
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except digitalocean.baseapi.Error:
             log.warning("CATCHING digitalocean.baseapi.Error, TRYING AGAIN")
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except ValueError:
             log.warning("CATCHING ValueError, TRYING AGAIN")
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except Exception:
             log.error("CATCHING Unknown Error, TRYING AGAIN")
-            time.sleep(5)
+            clock.sleep(5)
             continue
 
         if snap_outcome:
@@ -421,40 +1411,59 @@ def wait_for_action(an_action: digitalocean.Action, check_freq: int) -> bool:
         return False
 
 
+def poll_action(an_action: digitalocean.Action, check_freq: int, repeat: int, deadline: Deadline = None) -> bool:
+    # same as digitalocean.Action.wait(), but sleeps using 'clock' and gives up at the deadline
+    counter = 0
+    while an_action.status == "in-progress":
+        if deadline is not None and deadline.expired():
+            log.warning("DEADLINE REACHED, NO LONGER WAITING FOR " + str(an_action))
+            break
+        clock.sleep(check_freq)
+        with profiler.span("Action.load", "api", action_id=an_action.id):
+            an_action.load()
+        counter += 1
+        if counter > repeat:
+            break
+    return an_action.status == "completed"
+
+
 def send_command(retries: int, obj: Any, method: str, *args, **kwargs) -> Any:
 
     # create dynamic function to run 'method' str as method
     # func = send_command(droplet, 'shutdown'), then func() == droplet.shutdown()
     run_command = getattr(obj, method)
     log.debug("EXECUTING COMMAND {!s}.{}()".format(obj, method))
+    # e.g 'Droplet.shutdown', 'Manager.get_all_droplets' or 'digitalocean.Tag'
+    span_name = getattr(obj, "__name__", type(obj).__name__) + "." + method
 
     for i in range(retries):
         try:
             # pass the args and kwargs through and run it
-            command_output = run_command(*args, **kwargs)
+            with profiler.span(span_name, "api", attempt=i + 1):
+                command_output = run_command(*args, **kwargs)
         except json.decoder.JSONDecodeError:
             log.warning("json.decoder.JSONDecodeError WHILE SENDING {!s}.{}(), TRYING AGAIN".format(obj, method))
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except digitalocean.baseapi.JSONReadError:
             log.warning("json.decoder.JSONReadError WHILE SENDING {!s}.{}(), TRYING AGAIN".format(obj, method))
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except digitalocean.baseapi.DataReadError:
             log.warning("json.decoder.DataReadError WHILE SENDING {!s}.{}(), TRYING AGAIN".format(obj, method))
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except digitalocean.baseapi.Error:
             log.warning("digitalocean.baseapi.Error, WHILE SENDING {!s}.{}(), TRYING AGAIN".format(obj, method))
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except ValueError:
             log.warning("ValueError, WHILE SENDING {!s}.{}(), TRYING AGAIN".format(obj, method))
-            time.sleep(5)
+            clock.sleep(5)
             continue
         except Exception:
             log.error("Unknown Error, WHILE SENDING {!s}.{}(), TRYING AGAIN".format(obj, method))
-            time.sleep(5)
+            clock.sleep(5)
             continue
         else:
             return command_output
@@ -462,12 +1471,14 @@ def send_command(retries: int, obj: Any, method: str, *args, **kwargs) -> Any:
     sys.exit(1)
 
 
+@profiled("phase", "shutdown")
 def turn_it_off(droplet: digitalocean.Droplet) -> bool:
     if droplet.status == "off":
         log.info("The Droplet '{!s}' Is Already Powered Off".format(droplet))
         return True
     elif droplet.status == "active":
-        log.info("Shutting Down : {!s}".format(droplet))
+        log.info("Shutting Down : {!s}".format(droplet), extra={"droplet_id": droplet.id, "phase": "shutdown"})
+        started = clock.monotonic()
         # send shutdown and capture that action's id
         shut_action_id = send_command(5, droplet, "shutdown")["action"]["id"]
         # print("shut_command: ", shut_command)
@@ -478,11 +1489,19 @@ def turn_it_off(droplet: digitalocean.Droplet) -> bool:
         log.debug("shut_outcome {}".format(shut_outcome))
         if shut_outcome:
             for i in range(50):
-                time.sleep(3)
+                clock.sleep(3)
                 send_command(5, droplet, "load")  # refresh droplet data, retry 5 times
                 log.debug("droplet.status {} i== {!s}".format(droplet.status, i))
                 if droplet.status == "off":
-                    log.info("Shutdown Completed " + str(droplet))
+                    log.info(
+                        "Shutdown Completed " + str(droplet),
+                        extra={
+                            "droplet_id": droplet.id,
+                            "action_id": shut_action_id,
+                            "phase": "shutdown",
+                            "duration": round(clock.monotonic() - started, 3),
+                        },
+                    )
                     return True
             log.error("SHUTDOWN FAILED, REPORTED 'shut_outcome'=='True' " + str(droplet) + str(shut_action))
             return False
@@ -494,14 +1513,22 @@ def turn_it_off(droplet: digitalocean.Droplet) -> bool:
         return False
 
 
-def start_backup(droplet: digitalocean.Droplet, keep: bool, tag_name: str) -> digitalocean.Action:
+def backup_name(droplet: digitalocean.Droplet, keep: bool, tag_name: str) -> str:
     backup_str = "--" + tag_name + "--"
     if keep:
         backup_str = "--" + tag_name + "-keep--"
-    snap_name = droplet.name + backup_str + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    # snap_name = droplet.name + "--dobackup--2018-05-02 12:37:52"
+    # droplet.name + "--dobackup--2018-05-02 12:37:52"
+    return droplet.name + backup_str + str(clock.now().strftime("%Y-%m-%d %H:%M:%S"))
 
-    log.info("Taking snapshot of " + droplet.name)
+
+@profiled("phase", "start-snapshot")
+def start_backup(
+    droplet: digitalocean.Droplet, keep: bool, tag_name: str, snap_name: str = None
+) -> digitalocean.Action:
+    if snap_name is None:
+        snap_name = backup_name(droplet, keep, tag_name)
+
+    log.info("Taking snapshot of " + droplet.name, extra={"droplet_id": droplet.id, "phase": "snapshot"})
     # power_off is hard power off dont want that
     snap_action_id = send_command(5, droplet, "take_snapshot", snap_name, power_off=False)["action"]["id"]
     # snap_action = droplet.get_action(snap["action"]["id"])
@@ -509,22 +1536,311 @@ def start_backup(droplet: digitalocean.Droplet, keep: bool, tag_name: str) -> di
     return snap_action
 
 
-def snap_completed(snap_action: digitalocean.Action) -> bool:
-    snap_outcome = wait_for_action(snap_action, 10)
+@profiled("phase", "snapshot")
+def snap_completed(snap_action: digitalocean.Action, deadline: Deadline = None) -> bool:
+    started = clock.monotonic()
+    snap_outcome = wait_for_action(snap_action, 10, deadline=deadline)
+    fields = {
+        "droplet_id": snap_action.resource_id,
+        "action_id": snap_action.id,
+        "phase": "snapshot",
+        "duration": round(clock.monotonic() - started, 3),
+    }
     if snap_outcome:
-        log.info(str(snap_action) + " Snapshot Completed")
+        log.info(str(snap_action) + " Snapshot Completed", extra=fields)
         return True
 
-    log.error("SNAPSHOT FAILED " + str(snap_action))
+    log.error("SNAPSHOT FAILED " + str(snap_action), extra=fields)
     return False
 
 
+def backup_droplets(
+    droplets: List[digitalocean.Droplet],
+    keep: bool,
+    tag_name: str,
+    live: bool,
+    transfer_regions: List[str],
+    transfer_workers: int,
+    deadline: Deadline = None,
+    prune: Dict[str, List[digitalocean.Snapshot]] = None,
+    hooks: Hooks = None,
+    claim: Callable[[digitalocean.Droplet], bool] = None,
+) -> List[BackupResult]:
+    # Snapshot the droplets, then power them back up and start the '--transfer-to' copies and the deletion
+    # of the 'prune' snapshots (by droplet id) of each droplet as soon as its new snapshot completes,
+    # while the rest are still in progress. Deleted snapshots are popped from 'prune'.
+    # Returns a BackupResult for every droplet, including the ones skipped because of the deadline, but not
+    # the ones 'claim' (e.g Shard.claim) returned False for, another shard backs those up
+    deadline = deadline or Deadline()
+    prune = prune or {}
+    hooks = hooks or Hooks()
+
+    def for_droplet(droplet: digitalocean.Droplet, func: Callable, *args) -> Any:
+        # so '--profile' attributes the spans of 'func' to the droplet, whichever thread runs it
+        with profiler.droplet(droplet):
+            return func(*args)
+
+    # with a live backup's post hook, the droplets whose post hook is still owed. It is owed once the
+    # pre hook succeeded, and runs even if anything after that fails, so no droplet is left e.g frozen
+    owe_post_hook = []  # type: List[Dict[str, Any]]
+    owe_lock = threading.Lock()
+
+    def run_post_hook(each: Dict[str, Any]) -> bool:
+        # runs the owed post hook once, returns whether it succeeded
+        with owe_lock:
+            owed = [i for i, owed_each in enumerate(owe_post_hook) if owed_each is each]
+            if not owed:
+                return True
+            del owe_post_hook[owed[0]]
+        hook_done, hook_duration = run_hook(hooks.post, each["droplet"], "post-snapshot", hooks)
+        each["hook_duration"] += hook_duration
+        return hook_done
+
+    def begin_backup(droplet: digitalocean.Droplet) -> Dict[str, Any]:
+        each = {"droplet": droplet, "hook_duration": 0.0}  # type: Dict[str, Any]
+        if deadline.near():
+            log.warning("DEADLINE NEAR, NOT STARTING THE BACKUP OF " + str(droplet))
+            each["skipped"] = "skipped, deadline near"
+            return each
+        if claim is not None and not claim(droplet):
+            log.info("{!s} Is Claimed By Another Shard".format(droplet))
+            each["claimed_elsewhere"] = True
+            return each
+        each["began"] = clock.monotonic()
+        each["original_status"] = droplet.status  # active or off
+        if live and hooks.pre:
+            hook_done, each["hook_duration"] = run_hook(hooks.pre, droplet, "pre-snapshot", hooks)
+            if not hook_done:
+                if hooks.post:  # undo whatever the pre hook did manage to do
+                    each["hook_duration"] += run_hook(hooks.post, droplet, "post-snapshot", hooks)[1]
+                each["skipped"] = "pre-snapshot hook failed"
+                return each
+        if live and hooks.post:
+            with owe_lock:
+                owe_post_hook.append(each)
+        if not live:
+            turn_it_off(droplet)
+        each["known_snapshot_ids"] = list(droplet.snapshot_ids)
+        each["snap_name"] = backup_name(droplet, keep, tag_name)
+        each["snap_action"] = start_backup(droplet, keep, tag_name, each["snap_name"])
+        each["started_at"] = clock.now()
+        each["transfers"] = {}  # region: future
+        each["pruned"] = {}  # snapshot id: future
+        return each
+
+    try:
+        if live and hooks.pre:
+            # the hooks of the whole fleet run in parallel, each snapshot starts as soon as its pre hook is done
+            hook_workers = max(1, min(MAX_HOOK_WORKERS, len(droplets)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=hook_workers, thread_name_prefix="hook") as pool:
+                begun = list(pool.map(lambda droplet: for_droplet(droplet, begin_backup, droplet), droplets))
+        else:
+            begun = [for_droplet(droplet, begin_backup, droplet) for droplet in droplets]
+        begun = [each for each in begun if "claimed_elsewhere" not in each]
+        started = [each for each in begun if "skipped" not in each]
+        skipped = [
+            BackupResult(
+                each["droplet"].id,
+                each["droplet"].name,
+                transfers={},
+                pruned={},
+                hook_duration=each["hook_duration"],
+                error=each["skipped"],
+            )
+            for each in begun
+            if "skipped" in each
+        ]
+        if started:
+            log.info("Backups Started, snap_actions: {!s}".format([each["snap_action"] for each in started]))
+
+        # transfers and deletes run in this pool, so they overlap with waiting for the other snapshots
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, transfer_workers), thread_name_prefix="stage"
+        ) as stage_pool:
+
+            def finish_backup(each: Dict[str, Any]) -> Dict[str, Any]:
+                droplet = each["droplet"]
+                # a powered off droplet can't be powered up before its snapshot is done, so it is always waited for
+                snap_done = snap_completed(each["snap_action"], deadline if live else None)
+                each["snapshot_duration"] = clock.monotonic() - each["began"]
+                if not run_post_hook(each):
+                    each["error"] = "post-snapshot hook failed"
+                reloaded = False
+                if not live and each["original_status"] != "off":
+                    was_off = droplet.status == "off"
+                    if not turn_it_on(droplet):
+                        each["error"] = "did not power back up"
+                    else:
+                        reloaded = was_off  # turn_it_on() reloads the droplet once it is up
+                    each["downtime"] = clock.monotonic() - each["began"]
+                if not snap_done:
+                    log.error("SNAPSHOT FAILED {!s} {!s}".format(each["snap_action"], droplet))
+                    each["error"] = "snapshot failed"
+                    return each
+                # not to the region it is already in
+                regions = [region for region in transfer_regions if region != droplet.region["slug"]]
+                # a request, unless turn_it_on() just reloaded the droplet
+                snapshot = find_new_snapshot(droplet, each["known_snapshot_ids"], refresh=not reloaded)
+                if snapshot is None and regions:
+                    log.error("CAN'T TRANSFER, THE NEW SNAPSHOT OF {!s} WAS NOT FOUND".format(droplet))
+                    each["error"] = "new snapshot not found"
+                    return each
+                if snapshot is not None:
+                    each["snapshot_id"] = snapshot.id
+                if catalog is not None:
+                    catalog.add_backup(droplet, each.get("snapshot_id"), each["snap_name"])
+                for region in regions:
+                    each["transfers"][region] = stage_pool.submit(
+                        for_droplet, droplet, transfer_snapshot, snapshot, region, deadline
+                    )
+                # only now that the new backup exists
+                for old_snapshot in prune.pop(str(droplet.id), []):
+                    each["pruned"][str(old_snapshot.id)] = stage_pool.submit(
+                        for_droplet, droplet, delete_snapshot, old_snapshot
+                    )
+                return each
+
+            wait_workers = max(1, min(MAX_WAIT_WORKERS, len(started)))
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=wait_workers, thread_name_prefix="wait"
+            ) as wait_pool:
+                finished = list(wait_pool.map(lambda each: for_droplet(each["droplet"], finish_backup, each), started))
+            # stage_pool's exit waits for the remaining transfers and deletes
+    finally:
+        # e.g start_backup() gave up and exited, the droplets that were already hooked still get their post hook
+        for each in list(owe_post_hook):
+            run_post_hook(each)
+
+    results = []
+    for each in finished:
+        transfers = {region: future.result() for region, future in each["transfers"].items()}
+        error = each.get("error")
+        if error is None and not all(transfers.values()):
+            error = "transfer failed"
+        results.append(
+            BackupResult(
+                each["droplet"].id,
+                each["droplet"].name,
+                snapshot_id=each.get("snapshot_id"),
+                snapshot_name=each["snap_name"],
+                action_id=each["snap_action"].id,
+                started_at=each["started_at"],
+                snapshot_duration=each["snapshot_duration"],
+                downtime=each.get("downtime", 0.0),
+                transfers=transfers,
+                pruned={snap_id: future.result() for snap_id, future in each["pruned"].items()},
+                hook_duration=each["hook_duration"],
+                error=error,
+            )
+        )
+    if any(result.transfers for result in results):
+        log.info("{} Snapshot Transfers Finished".format(sum(len(result.transfers) for result in results)))
+    return results + skipped
+
+
+def run_hook(command: str, droplet: digitalocean.Droplet, phase: str, hooks: Hooks) -> Tuple[bool, float]:
+    # returns whether the hook succeeded and how long it took
+    values = {"{name}": droplet.name, "{id}": droplet.id, "{ip}": droplet.ip_address}
+    # only these placeholders, other braces e.g "awk '{print $1}'" or "${VAR}" are left as they are
+    for placeholder, value in values.items():
+        command = command.replace(placeholder, shlex.quote(str(value)))
+    env = dict(
+        os.environ,
+        DOBACKUP_HOOK=phase,
+        DOBACKUP_DROPLET_ID=str(droplet.id),
+        DOBACKUP_DROPLET_NAME=droplet.name,
+        DOBACKUP_DROPLET_IP=str(droplet.ip_address),
+    )
+    if hooks.ssh_user:
+        target = "{}@{}".format(hooks.ssh_user, droplet.ip_address)
+        argv = [
+            {"{target}": target, "{command}": command}.get(arg, arg) for arg in shlex.split(hooks.ssh_command)
+        ]  # type: Any
+    else:
+        argv = command
+    fields = {"droplet_id": droplet.id, "phase": phase + "-hook"}  # type: Dict[str, Any]
+    log.info("Running The {} Hook Of {!s}".format(phase, droplet), extra=fields)
+    started = clock.monotonic()
+    try:
+        with profiler.span(phase + "-hook", "phase"):
+            # in its own process group, so a timeout also kills what the hook started, e.g. the command
+            # behind a shell or ssh, which would otherwise keep the output pipe open and the run waiting
+            proc = subprocess.Popen(
+                argv,
+                shell=not hooks.ssh_user,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                start_new_session=True,
+            )
+            try:
+                output = proc.communicate(timeout=hooks.timeout)[0].strip()
+                hook_done = proc.returncode == 0
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.communicate()
+                hook_done = False
+                output = "timed out after {} seconds".format(hooks.timeout)
+    except OSError as e:
+        hook_done = False
+        output = str(e)
+    fields["duration"] = round(clock.monotonic() - started, 3)
+    if hook_done:
+        log.info("The {} Hook Of {!s} Finished {}".format(phase, droplet, output), extra=fields)
+    else:
+        log.error("THE {} HOOK OF {!s} FAILED {}".format(phase.upper(), droplet, output), extra=fields)
+    return hook_done, fields["duration"]
+
+
+@profiled("phase", "find-new-snapshot")
+def find_new_snapshot(
+    droplet: digitalocean.Droplet, known_snapshot_ids: List[int], refresh: bool = True
+) -> digitalocean.Image:
+    # the snapshot taken by 'start_backup' is the one that wasn't there before it
+    for attempt in range(FIND_SNAPSHOT_TRIES):
+        if refresh or attempt > 0:
+            if attempt > 0:
+                clock.sleep(5)  # droplet.snapshot_ids can lag behind the completed action
+            send_command(5, droplet, "load")  # refresh droplet.snapshot_ids
+        new_ids = [snap_id for snap_id in droplet.snapshot_ids if snap_id not in known_snapshot_ids]
+        if new_ids:
+            return digitalocean.Image(token=droplet.token, id=max(new_ids))
+    log.warning("COULD NOT FIND THE NEW SNAPSHOT OF " + str(droplet))
+    return None
+
+
+@profiled("phase", "transfer")
+def transfer_snapshot(snapshot: digitalocean.Image, region: str, deadline: Deadline = None) -> bool:
+    if deadline is not None and deadline.expired():
+        log.warning("DEADLINE REACHED, NOT TRANSFERRING SNAPSHOT {!s} TO {}".format(snapshot.id, region))
+        return False
+    # own Image object per transfer, the requests session is not shared between threads
+    snapshot = digitalocean.Image(token=snapshot.token, id=snapshot.id)
+    fields = {"phase": "transfer"}  # type: Dict[str, Any]
+    log.info("Transferring Snapshot {!s} To {}".format(snapshot.id, region), extra=fields)
+    started = clock.monotonic()
+    transfer_action_id = send_command(5, snapshot, "transfer", region)["action"]["id"]
+    transfer_action = send_command(5, digitalocean.Action, "get_object", snapshot.token, transfer_action_id)
+    fields["action_id"] = transfer_action_id
+    # copies between regions take a lot longer than snapshots, keep checking for an hour
+    transfer_outcome = wait_for_action(transfer_action, 10, repeat=360, deadline=deadline)
+    fields["duration"] = round(clock.monotonic() - started, 3)
+    if transfer_outcome:
+        log.info("Snapshot {!s} Transferred To {}".format(snapshot.id, region), extra=fields)
+        return True
+    log.error("SNAPSHOT TRANSFER FAILED {!s} TO {} {!s}".format(snapshot.id, region, transfer_action), extra=fields)
+    return False
+
+
+@profiled("phase", "powerup")
 def turn_it_on(droplet: digitalocean.Droplet) -> bool:
     if droplet.status == "active":
         log.info("The Droplet '{!s}' Is Already Powered Up".format(droplet))
         return True
     elif droplet.status == "off":
-        log.info("Powering Up {!s}".format(droplet))
+        log.info("Powering Up {!s}".format(droplet), extra={"droplet_id": droplet.id, "phase": "powerup"})
+        started = clock.monotonic()
         power_up_action_id = send_command(5, droplet, "power_on")["action"]["id"]
         power_up_action = send_command(5, droplet, "get_action", power_up_action_id)
         log.debug("power_up_action " + str(power_up_action) + str(type(power_up_action)))
@@ -532,11 +1848,19 @@ def turn_it_on(droplet: digitalocean.Droplet) -> bool:
         log.debug("power_up_outcome " + str(power_up_outcome))
         if power_up_outcome:
             for i in range(5):
-                time.sleep(2)
+                clock.sleep(2)
                 droplet.load()  # refresh droplet data
                 log.debug("droplet.status " + droplet.status)
                 if droplet.status == "active":
-                    log.info("Powered Back Up {!s}".format(droplet))
+                    log.info(
+                        "Powered Back Up {!s}".format(droplet),
+                        extra={
+                            "droplet_id": droplet.id,
+                            "action_id": power_up_action_id,
+                            "phase": "powerup",
+                            "duration": round(clock.monotonic() - started, 3),
+                        },
+                    )
                     return True
             log.critical("DID NOT POWER UP BUT REPORTED 'powered_up'=='True' " + str(droplet))
             return False
@@ -548,12 +1872,16 @@ def turn_it_on(droplet: digitalocean.Droplet) -> bool:
         return False
 
 
+@profiled("list")
 def find_old_backups(manager: digitalocean.Manager, older_than: int, tag_name: str) -> List[digitalocean.Snapshot]:
     old_snapshots = []
     tag_str = "--" + tag_name + "--"
-    last_backup_to_keep = datetime.datetime.now() - datetime.timedelta(days=older_than)
+    last_backup_to_keep = clock.now() - datetime.timedelta(days=older_than)
+    snapshots = send_command(5, manager, "get_droplet_snapshots")
+    if catalog is not None:
+        catalog.sync_snapshots(snapshots)
 
-    for each_snapshot in send_command(5, manager, "get_droplet_snapshots"):
+    for each_snapshot in snapshots:
         # print(each_snapshot.name, each_snapshot.created_at, each_snapshot.id)
         if tag_str in each_snapshot.name:
             backed_on = each_snapshot.name[each_snapshot.name.find(tag_str) + len(tag_str):]
@@ -566,55 +1894,77 @@ def find_old_backups(manager: digitalocean.Manager, older_than: int, tag_name: s
     return old_snapshots
 
 
-def delete_snapshot(each_snapshot: digitalocean.Snapshot) -> None:
-    log.warning("Deleting Snapshot : " + str(each_snapshot))
+@profiled("phase", "delete")
+def delete_snapshot(each_snapshot: digitalocean.Snapshot) -> bool:
+    fields = {"droplet_id": each_snapshot.resource_id, "phase": "delete"}
+    log.warning("Deleting Snapshot : " + str(each_snapshot), extra=fields)
     destroyed = send_command(5, each_snapshot, "destroy")
     if destroyed:
-        log.info("Successfully Destroyed The Snapshot")
-    else:
-        log.error("COULD NOT DESTROY SNAPSHOT " + str(each_snapshot))
+        log.info("Successfully Destroyed The Snapshot", extra=fields)
+        if catalog is not None:
+            catalog.remove_snapshot(each_snapshot.id)
+        return True
+    log.error("COULD NOT DESTROY SNAPSHOT " + str(each_snapshot), extra=fields)
+    return False
 
 
-def do_tag_droplet(do_token: str, droplet_id: str, tag_name: str) -> None:
+def do_tag_droplet(do_token: str, droplet_ids: List[str], tag_name: str) -> None:
     # backup_tag = digitalocean.Tag(token=do_token, name=tag_name)
     backup_tag = send_command(5, digitalocean, "Tag", token=do_token, name=tag_name)
     backup_tag.create()  # create tag if not already created
-    backup_tag.add_droplets([droplet_id])
+    backup_tag.add_droplets(droplet_ids)  # all of them in one request
+    log.info("Tagged {} Droplet(s) With '{}'".format(len(droplet_ids), tag_name))
 
 
-def do_untag_droplet(do_token: str, droplet_id: str, tag_name: str) -> bool:
+def do_untag_droplet(do_token: str, droplet_ids: List[str], tag_name: str) -> bool:
     # backup_tag = digitalocean.Tag(token=do_token, name=tag_name)
     backup_tag = send_command(5, digitalocean, "Tag", token=do_token, name=tag_name)
     try:
-        # backup_tag.remove_droplets([droplet_id])
-        send_command(5, backup_tag, "remove_droplets", [droplet_id])
+        # backup_tag.remove_droplets(droplet_ids)
+        send_command(5, backup_tag, "remove_droplets", droplet_ids)
+        log.info("Untagged {} Droplet(s) From '{}'".format(len(droplet_ids), tag_name))
         return True
     except digitalocean.baseapi.NotFoundError:
         log.error("THE GIVEN TAG DOES NOT EXIST")
         return False
 
 
+@profiled("list")
 def list_all_droplets(manager: digitalocean.Manager) -> None:
     # my_droplets = manager.get_all_droplets()
     my_droplets = send_command(5, manager, "get_all_droplets")
+    if catalog is not None:
+        catalog.sync_droplets(my_droplets)
     log.info("Listing All Droplets:  ")
     log.info("<droplet-id>   <droplet-name>   <droplet-status>      <ip-addr>       <memory>\n")
-    for droplet in my_droplets:
-        log.info(str(droplet).ljust(40) + droplet.status.ljust(12) + droplet.ip_address.ljust(22) + str(droplet.memory))
+    # one log record for the whole listing, not one per droplet
+    log.info(
+        "\n".join(
+            str(droplet).ljust(40) + droplet.status.ljust(12) + droplet.ip_address.ljust(22) + str(droplet.memory)
+            for droplet in my_droplets
+        )
+    )
 
 
+@profiled("list")
 def get_tagged(manager: digitalocean.Manager, tag_name: str) -> None:
     # tagged_droplets = manager.get_all_droplets(tag_name=tag_name)
     tagged_droplets = send_command(5, manager, "get_all_droplets", tag_name=tag_name)
+    if catalog is not None:
+        catalog.sync_droplets(tagged_droplets, tag_name)
     return tagged_droplets
 
 
+@profiled("list")
 def list_snapshots(manager: digitalocean.Manager) -> None:
     log.info("All Available Snapshots Are : <snapshot-name>          <snapshot-id>\n")
     # snapshots = [[snap.name, snap.id] for snap in manager.get_all_snapshots()]
-    snapshots = [[snap.name, snap.id] for snap in send_command(5, manager, "get_all_snapshots")]
+    all_snapshots = send_command(5, manager, "get_all_snapshots")
+    if catalog is not None:
+        catalog.sync_snapshots(all_snapshots)
+    snapshots = [[snap.name, snap.id] for snap in all_snapshots]
     snapshots.sort()
-    [log.info(snap[0].ljust(70) + snap[1]) for snap in snapshots]
+    log.info("\n".join(snap[0].ljust(70) + snap[1] for snap in snapshots))
 
 
 def set_manager(do_token: str) -> digitalocean.Manager:
@@ -623,6 +1973,133 @@ def set_manager(do_token: str) -> digitalocean.Manager:
     return manager
 
 
+def acquire_run_lock(do_token: str, tag_name: str, lock_dir: str = __basefilepath__) -> str:
+    # One lock file per token and tag, so overlapping cron runs don't fight over the same droplets.
+    # Returns the lock's path, or None if another live run holds it
+    lock_path = run_lock_path(do_token, tag_name, lock_dir)
+    lock_info = {"pid": os.getpid(), "host": socket.gethostname(), "started": time.time()}
+    for attempt in range(2):
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            if attempt == 0 and remove_stale_lock(lock_path):
+                continue
+            log.error("ANOTHER DOBACKUP RUN WITH THE SAME TOKEN AND TAG IS STILL GOING, LOCK FILE: " + lock_path)
+            return None
+        lock_content = json.dumps(lock_info)
+        with os.fdopen(lock_fd, "w") as lock_file:
+            lock_file.write(lock_content)
+        held_run_locks[lock_path] = lock_content
+        return lock_path
+    return None
+
+
+# path: content of the locks this process holds, so it only ever removes its own
+held_run_locks = {}  # type: Dict[str, str]
+
+
+def run_lock_path(do_token: str, tag_name: str, lock_dir: str = __basefilepath__) -> str:
+    token_hash = hashlib.sha256(do_token.encode()).hexdigest()[:12]
+    return os.path.join(lock_dir, ".lock-{}-{}".format(token_hash, tag_name))
+
+
+def shards_apart(do_token: str, tag_name: str, shard: Shard = None, lock_dir: str = __basefilepath__) -> bool:
+    # A sharded and a plain run of the same tag must not overlap, though shards each have their own lock. Both
+    # kinds take their own lock first and then look for the other kind's, so at worst both back off
+    tag_lock_path = run_lock_path(do_token, tag_name, lock_dir)
+    if shard:
+        other_lock_paths = [tag_lock_path]
+    else:
+        other_lock_paths = glob.glob(glob.escape(tag_lock_path) + "-shard-*")
+    for other_lock_path in other_lock_paths:
+        try:
+            with open(other_lock_path) as lock_file:
+                lock_content = lock_file.read()
+        except FileNotFoundError:
+            continue
+        if not lock_is_stale(other_lock_path, lock_content):
+            log.error(
+                "A {} DOBACKUP RUN WITH THE SAME TOKEN AND TAG IS STILL GOING, LOCK FILE: {}".format(
+                    "PLAIN" if shard else "SHARDED", other_lock_path
+                )
+            )
+            return False
+    return True
+
+
+def remove_stale_lock(lock_path: str) -> bool:
+    # Returns True if the lock is gone and can be taken. Two runs can find the same lock stale, and the slower
+    # one must not remove the lock the faster one has just taken instead. So the lock is moved aside atomically,
+    # and only removed if it is still the one that was found stale
+    try:
+        with open(lock_path) as lock_file:
+            stale_content = lock_file.read()
+    except FileNotFoundError:
+        return True  # released meanwhile
+    if not lock_is_stale(lock_path, stale_content):
+        return False
+    removed = remove_lock_if_unchanged(lock_path, stale_content)
+    if removed:
+        log.warning("Removed Stale Lock File " + lock_path)
+    # None, another run moved it first, creating the lock decides which run gets it
+    return removed is not False
+
+
+def remove_lock_if_unchanged(lock_path: str, lock_content: Optional[str]) -> Optional[bool]:
+    # Removes the lock only if it still has 'lock_content'. It is moved aside atomically first, so a lock another
+    # run has just put in its place is never removed. Returns None if there was no lock to remove
+    moved_path = "{}.removing-{}-{}".format(lock_path, socket.gethostname(), os.getpid())
+    try:
+        os.rename(lock_path, moved_path)
+    except FileNotFoundError:
+        return None
+    with open(moved_path) as moved_file:
+        moved_content = moved_file.read()
+    if moved_content == lock_content:
+        os.remove(moved_path)
+        return True
+    # another run's lock, put it back
+    try:
+        os.link(moved_path, lock_path)
+    except FileExistsError:
+        # yet another run took the lock meanwhile, leave the moved lock alone rather than lose it
+        log.warning("COULD NOT PUT BACK THE LOCK OF ANOTHER RUN, IT IS LEFT IN " + moved_path)
+        return False
+    os.remove(moved_path)
+    return False
+
+
+def lock_is_stale(lock_path: str, lock_content: str) -> bool:
+    try:
+        lock_info = json.loads(lock_content)
+    except ValueError:
+        # half written, only stale if it has been like that for a while
+        try:
+            return time.time() - os.path.getmtime(lock_path) > 60
+        except FileNotFoundError:
+            return True  # released meanwhile
+    if time.time() - lock_info.get("started", 0) > LOCK_STALE_AFTER:
+        return True
+    if lock_info.get("host") != socket.gethostname():
+        return False  # can't check processes on other hosts
+    try:
+        os.kill(lock_info["pid"], 0)
+    except ProcessLookupError:
+        return True  # the run that took the lock is gone
+    except PermissionError:
+        pass  # running, as another user
+    return False
+
+
+def release_run_lock(lock_path: str) -> None:
+    # a run that outlived LOCK_STALE_AFTER may have had its lock taken over, that one isn't removed
+    removed = remove_lock_if_unchanged(lock_path, held_run_locks.pop(lock_path, None))
+    if removed is None:
+        log.warning("Lock File Was Already Removed " + lock_path)
+    elif not removed:
+        log.warning("THE LOCK WAS TAKEN OVER BY ANOTHER RUN, LEAVING IT IN PLACE " + lock_path)
+
+
 def get_token(token_id: int) -> str:
     token_key = "token" + str(token_id)
     try:
@@ -638,16 +2115,19 @@ def get_token(token_id: int) -> str:
         return ""
 
 
+@profiled("list")
 def list_all_tags(manager: digitalocean.Manager) -> None:
     # all_tags = manager.get_all_tags()
     all_tags = send_command(5, manager, "get_all_tags")
     log.info("All Available Tags Are : ")
-    for tag in all_tags:
-        log.info(tag.name)
+    log.info("\n".join(tag.name for tag in all_tags))
 
 
+@profiled("list")
 def find_droplet(droplet_str: str, manager: digitalocean.Manager) -> digitalocean.Droplet:
     all_droplets = send_command(5, manager, "get_all_droplets")
+    if catalog is not None:
+        catalog.sync_droplets(all_droplets)
     for drop in all_droplets:
         log.debug(str(type(drop)) + str(drop))
         if drop.name == droplet_str:
@@ -659,18 +2139,76 @@ def find_droplet(droplet_str: str, manager: digitalocean.Manager) -> digitalocea
     log.error("NO DROPLET FOUND WITH THE GIVEN NAME OR ID")
 
 
+@profiled("list")
+def find_droplets(droplet_strs: str, manager: digitalocean.Manager) -> List[digitalocean.Droplet]:
+    # droplet_strs is comma seperated names, ids, globs ('web-*') or regexes ('re:^web-[0-9]+$'),
+    # all resolved against a single listing. Returns [] if any of them matches nothing
+    all_droplets = send_command(5, manager, "get_all_droplets")
+    if catalog is not None:
+        catalog.sync_droplets(all_droplets)
+    found = {}  # type: Dict[int, digitalocean.Droplet]
+    for droplet_str in split_droplet_strs(droplet_strs):
+        droplet_str = droplet_str.strip()
+        if droplet_str.startswith("re:"):
+            try:
+                pattern = re.compile(droplet_str[len("re:"):])
+            except re.error as e:
+                log.error("INVALID REGEX '{}' : {}".format(droplet_str, e))
+                return []
+            matches = [drop for drop in all_droplets if pattern.search(drop.name)]
+        else:
+            matches = [
+                drop
+                for drop in all_droplets
+                if fnmatch.fnmatchcase(drop.name, droplet_str) or str(drop.id) == droplet_str
+            ]
+        if not matches:
+            log.error("NO DROPLET FOUND WITH THE NAME, ID OR PATTERN '{}'".format(droplet_str))
+            return []
+        for drop in matches:
+            found[drop.id] = drop
+    log.debug("Found droplets {!s} for '{}'".format(list(found.values()), droplet_strs))
+    return list(found.values())
+
+
+def split_droplet_strs(droplet_strs: str) -> List[str]:
+    # split on the commas outside (), [] and {}, so regexes like 're:^web-[0-9]{1,3}$' stay whole.
+    # Droplet names can't have commas, so a regex has no other use for them
+    parts = [""]
+    depth = 0
+    escaped = False
+    for char in droplet_strs:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth = max(0, depth - 1)
+        elif char == "," and depth == 0:
+            parts.append("")
+            continue
+        parts[-1] += char
+    return parts
+
+
 # Note: Snapshot.resource_id and Snapshot.id are str not int
+@profiled("list")
 def find_snapshot(snap_id_or_name: str, manager: digitalocean.Manager, do_token: str) -> digitalocean.Snapshot:
     snap_id_or_name = str(snap_id_or_name)  # for comparisons
-    for snap in send_command(5, manager, "get_all_snapshots"):
+    all_snapshots = send_command(5, manager, "get_all_snapshots")
+    if catalog is not None:
+        catalog.sync_snapshots(all_snapshots)
+    for snap in all_snapshots:
         if snap_id_or_name == str(snap.id) or snap_id_or_name == snap.name:
-            # snap_obj = digitalocean.Snapshot.get_object(do_token, snap.id)
-            snap_obj = send_command(5, digitalocean.Snapshot, "get_object", do_token, snap.id)
+            # the listing already has everything, no need for digitalocean.Snapshot.get_object(do_token, snap.id)
             # log.info("snap id and name {!s} {!s}".format(snap.id, snap.name))
-            return snap_obj
+            return snap
     log.error("NO SNAPSHOT FOUND WITH NAME OR ID OF {!s}, EXITING".format(snap_id_or_name))
 
 
+@profiled("list")
 def list_taken_backups(manager: digitalocean.Manager, tag_name: str) -> None:
     tag_str = "--" + tag_name + "--"
     tag_str_keep = "--" + tag_name + "-keep--"
@@ -681,34 +2219,268 @@ def list_taken_backups(manager: digitalocean.Manager, tag_name: str) -> None:
         )
     )
     backups = []
-    for snap in send_command(5, manager, "get_all_snapshots"):
+    all_snapshots = send_command(5, manager, "get_all_snapshots")
+    if catalog is not None:
+        catalog.sync_snapshots(all_snapshots)
+    for snap in all_snapshots:
         if tag_str in snap.name or tag_str_keep in snap.name:
             backups.append([snap.name, snap.id])
 
     backups.sort()
-    [log.info(snap[0].ljust(70) + snap[1]) for snap in backups]
+    log.info("\n".join(snap[0].ljust(70) + snap[1] for snap in backups))
+
+
+@profiled("list")
+def sync_catalog(manager: digitalocean.Manager) -> None:
+    snapshot_changes = catalog.sync_snapshots(send_command(5, manager, "get_droplet_snapshots"))
+    catalog.sync_droplets(send_command(5, manager, "get_all_droplets"))
+    log.info("Catalog Synced, Snapshots {} Added, {} Updated, {} Removed".format(*snapshot_changes))
+
+
+def catalog_time(timestamp: float) -> str:
+    if timestamp is None:
+        return "never"
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+@profiled("list")
+def list_latest_backups(run_catalog: Catalog, tag_name: str) -> None:
+    log.info(
+        "Latest Backup Of Each Droplet With '--{}--', Catalog Synced {} :"
+        " <droplet-name>   <backed-up>   <snapshot-id>\n".format(
+            tag_name, catalog_time(run_catalog.last_synced("snapshots"))
+        )
+    )
+    log.info(
+        "\n".join(
+            str(droplet_name or droplet_id).ljust(30) + catalog_time(created_at).ljust(22) + snap_id
+            for droplet_id, droplet_name, snap_id, snap_name, created_at in run_catalog.latest_backups(tag_name)
+        )
+    )
+
+
+@profiled("list")
+def list_not_backed_up(run_catalog: Catalog, tag_name: str, hours: float) -> bool:
+    # returns True if every droplet has a recent enough backup
+    stale = run_catalog.not_backed_up_in(tag_name, hours)
+    if not stale:
+        log.info("All Droplets With '{}' Have A Backup From The Last {} Hours".format(tag_name, hours))
+        return True
+    log.warning(
+        "{} DROPLET(S) WITH NO BACKUP IN THE LAST {} HOURS : <droplet-name>   <last-backup>".format(len(stale), hours)
+    )
+    log.warning("\n".join(str(name).ljust(30) + catalog_time(latest) for droplet_id, name, latest in stale))
+    return False
+
+
+@profiled("list")
+def list_backup_storage(run_catalog: Catalog) -> None:
+    log.info("Backup Storage Per Tag : <tag>   <snapshots>   <size-gigabytes>\n")
+    log.info(
+        "\n".join(
+            str(tag_name if tag_name is not None else "(not dobackup)").ljust(30)
+            + str(count).ljust(12)
+            + str(round(gigabytes or 0, 2))
+            for tag_name, count, gigabytes in run_catalog.storage_per_tag()
+        )
+    )
 
 
+@profiled("phase", "restore")
 def restore_droplet(
-    droplet: digitalocean.Droplet, snapshot: digitalocean.Snapshot, manager: digitalocean.Manager, do_token: str
-):
+    droplet: digitalocean.Droplet,
+    snapshot: digitalocean.Snapshot,
+    manager: digitalocean.Manager,
+    do_token: str,
+    confirm: bool = True,
+) -> RestoreResult:
     snap = find_snapshot(snapshot, manager, do_token)
 
-    if snap:
-        log.info(str(snap) + " Is A Valid Snapshot\n")
-        confirmation = input(f"Are You Sure You Want To Restore {droplet.name}? (if so, type 'yes') ")
-        if confirmation.lower() == "yes":
-            log.info("Starting Restore Process")
-            restore_act_id = send_command(5, droplet, "restore", (int(snap.id)))["action"]["id"]
-            restore_act = send_command(5, droplet, "get_action", restore_act_id)
-            restore_outcome = wait_for_action(restore_act, 10)
-            if restore_outcome:
-                log.info(str(restore_act) + " Restore Completed")
-            else:
-                log.error("RESTORE FAILED " + str(restore_act))
-
     if not snap:
         log.error(str(snapshot) + " IS NOT A VALID SNAPSHOT")
+        return RestoreResult(droplet.id, error="not a valid snapshot")
+
+    log.info(str(snap) + " Is A Valid Snapshot\n")
+    if confirm:
+        flush_logs()  # so the log lines appear before the prompt
+        confirmation = input(f"Are You Sure You Want To Restore {droplet.name}? (if so, type 'yes') ")
+        if confirmation.lower() != "yes":
+            return RestoreResult(droplet.id, snap.id, error="not confirmed")
+    log.info("Starting Restore Process")
+    started = clock.monotonic()
+    restore_act_id = send_command(5, droplet, "restore", (int(snap.id)))["action"]["id"]
+    restore_act = send_command(5, droplet, "get_action", restore_act_id)
+    restore_outcome = wait_for_action(restore_act, 10)
+    duration = clock.monotonic() - started
+    fields = {"droplet_id": droplet.id, "action_id": restore_act_id, "phase": "restore", "duration": duration}
+    if restore_outcome:
+        log.info(str(restore_act) + " Restore Completed", extra=fields)
+        return RestoreResult(droplet.id, snap.id, restore_act_id, duration)
+    log.error("RESTORE FAILED " + str(restore_act), extra=fields)
+    return RestoreResult(droplet.id, snap.id, restore_act_id, duration, error="restore failed")
+
+
+class BackupClient:
+    """Use dobackup from python. Keeps one manager for all the calls and returns results instead of logging them.
+
+    client = BackupClient(token_id=0)
+    result = client.backup("ubuntu-18-04")
+    if result.ok:
+        print(result.snapshot_id)
+    """
+
+    def __init__(self, token: str = None, token_id: int = 0, tag_name: str = "dobackup") -> None:
+        self.token = token or get_token(token_id)
+        if not self.token:
+            raise ValueError("No token given and none stored with '--init' for token_id {}".format(token_id))
+        self.tag_name = tag_name
+        self.manager = set_manager(self.token)
+
+    def _droplet(self, droplet_str: str) -> digitalocean.Droplet:
+        droplet = find_droplet(str(droplet_str), self.manager)
+        if droplet is None:
+            raise LookupError("No droplet with the name or id " + str(droplet_str))
+        return droplet
+
+    def _backup(
+        self,
+        droplets: List[digitalocean.Droplet],
+        live: bool,
+        keep: bool = False,
+        transfer_to: List[str] = (),
+        transfer_workers: int = 4,
+        deadline: Deadline = None,
+        prune_older_than: int = None,
+        hooks: Hooks = None,
+    ) -> List[BackupResult]:
+        prune = {}  # type: Dict[str, List[digitalocean.Snapshot]]
+        if prune_older_than is not None:
+            for snap in find_old_backups(self.manager, prune_older_than, self.tag_name):
+                prune.setdefault(str(snap.resource_id), []).append(snap)
+        return backup_droplets(
+            droplets,
+            keep,
+            self.tag_name,
+            live,
+            list(transfer_to),
+            transfer_workers,
+            deadline=deadline,
+            prune=prune,
+            hooks=hooks,
+        )
+
+    def backup(
+        self,
+        droplet: str,
+        *,
+        keep: bool = False,
+        transfer_to: List[str] = (),
+        transfer_workers: int = 4,
+        deadline: Deadline = None,
+        prune_older_than: int = None,
+        hooks: Hooks = None,
+    ) -> BackupResult:
+        return self._backup(
+            [self._droplet(droplet)],
+            False,
+            keep=keep,
+            transfer_to=transfer_to,
+            transfer_workers=transfer_workers,
+            deadline=deadline,
+            prune_older_than=prune_older_than,
+            hooks=hooks,
+        )[0]
+
+    def backup_all(
+        self,
+        *,
+        keep: bool = False,
+        transfer_to: List[str] = (),
+        transfer_workers: int = 4,
+        deadline: Deadline = None,
+        prune_older_than: int = None,
+        hooks: Hooks = None,
+    ) -> List[BackupResult]:
+        return self._backup(
+            self.list_tagged(),
+            False,
+            keep=keep,
+            transfer_to=transfer_to,
+            transfer_workers=transfer_workers,
+            deadline=deadline,
+            prune_older_than=prune_older_than,
+            hooks=hooks,
+        )
+
+    def live_backup(
+        self,
+        droplet: str,
+        *,
+        keep: bool = False,
+        transfer_to: List[str] = (),
+        transfer_workers: int = 4,
+        deadline: Deadline = None,
+        prune_older_than: int = None,
+        hooks: Hooks = None,
+    ) -> BackupResult:
+        return self._backup(
+            [self._droplet(droplet)],
+            True,
+            keep=keep,
+            transfer_to=transfer_to,
+            transfer_workers=transfer_workers,
+            deadline=deadline,
+            prune_older_than=prune_older_than,
+            hooks=hooks,
+        )[0]
+
+    def live_backup_all(
+        self,
+        *,
+        keep: bool = False,
+        transfer_to: List[str] = (),
+        transfer_workers: int = 4,
+        deadline: Deadline = None,
+        prune_older_than: int = None,
+        hooks: Hooks = None,
+    ) -> List[BackupResult]:
+        return self._backup(
+            self.list_tagged(),
+            True,
+            keep=keep,
+            transfer_to=transfer_to,
+            transfer_workers=transfer_workers,
+            deadline=deadline,
+            prune_older_than=prune_older_than,
+            hooks=hooks,
+        )
+
+    def prune(self, older_than: int) -> PruneResult:
+        deleted = []
+        failed = []
+        for snap in find_old_backups(self.manager, older_than, self.tag_name):
+            (deleted if delete_snapshot(snap) else failed).append(str(snap.id))
+        return PruneResult(deleted, failed)
+
+    def restore(self, droplet: str, snapshot: str) -> RestoreResult:
+        return restore_droplet(self._droplet(droplet), snapshot, self.manager, self.token, confirm=False)
+
+    def list_droplets(self) -> List[digitalocean.Droplet]:
+        return send_command(5, self.manager, "get_all_droplets")
+
+    def list_tagged(self) -> List[digitalocean.Droplet]:
+        return get_tagged(self.manager, tag_name=self.tag_name)
+
+    def list_snapshots(self) -> List[digitalocean.Snapshot]:
+        return send_command(5, self.manager, "get_all_snapshots")
+
+    def list_backups(self) -> List[digitalocean.Snapshot]:
+        tag_str = "--" + self.tag_name + "--"
+        tag_str_keep = "--" + self.tag_name + "-keep--"
+        return [snap for snap in self.list_snapshots() if tag_str in snap.name or tag_str_keep in snap.name]
+
+    def list_older_than(self, older_than: int) -> List[digitalocean.Snapshot]:
+        return find_old_backups(self.manager, older_than, self.tag_name)
 
 
 if __name__ == "__main__":
@@ -4,13 +4,16 @@ import argparse
 import datetime
 import json
 import logging.handlers
+import os
 import sys
+import threading
 import time
 
 import digitalocean
 
 import mock
 import pytest
+import requests
 from dobackup import dobackup
 
 
@@ -159,3 +162,593 @@ def test_main():
     #              list_older_than, tag_server, untag_server, tag_name, delete_older_than,
     #              delete_snap, backup, backup_all, shutdown, powerup, restore_drop,
     #              restore_to)
+
+
+def test_json_lines_formatter():
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, "Snapshot %s Completed", ("x",), None)
+    record.droplet_id = 123
+    record.phase = "snapshot"
+    record.duration = 1.5
+    entry = json.loads(dobackup.JsonLinesFormatter().format(record))
+    assert entry["message"] == "Snapshot x Completed"
+    assert entry["level"] == "INFO"
+    assert entry["droplet_id"] == 123
+    assert entry["phase"] == "snapshot"
+    assert entry["duration"] == 1.5
+    assert "action_id" not in entry
+
+
+def test_backup_droplets_transfers_each_new_snapshot():
+    droplets = [mock.Mock(id=i, status="active", snapshot_ids=[], region={"slug": "nyc3"}) for i in range(3)]
+    for drop in droplets:
+        drop.name = "drop-{}".format(drop.id)
+    turn_it_on = mock.Mock(return_value=True)
+    transfer_snapshot = mock.Mock(return_value=True)
+    with mock.patch.multiple(
+        "dobackup.dobackup",
+        turn_it_off=mock.DEFAULT,
+        turn_it_on=turn_it_on,
+        start_backup=mock.Mock(side_effect=lambda droplet, *args: mock.Mock(failing=droplet.id == 1)),
+        snap_completed=mock.Mock(side_effect=lambda snap_action, deadline: not snap_action.failing),
+        find_new_snapshot=mock.Mock(side_effect=lambda droplet, known, refresh: mock.Mock(id=droplet.id * 100)),
+        transfer_snapshot=transfer_snapshot,
+    ):
+        results = dobackup.backup_droplets(droplets, False, "dobackup", False, ["nyc3", "ams3", "sfo2"], 2)
+    assert [result.error for result in results] == [None, "snapshot failed", None]
+    assert results[0].transfers == {"ams3": True, "sfo2": True}
+    assert turn_it_on.call_count == 3
+    # the failed snapshot isn't transferred, and nothing is copied to the region it is already in
+    regions = [c[0][1] for c in transfer_snapshot.call_args_list]
+    assert sorted(regions) == ["ams3", "ams3", "sfo2", "sfo2"]
+
+
+def test_find_droplets_patterns():
+    all_droplets = [mock.Mock(id=i) for i in (1, 2, 3, 4)]
+    for drop, name in zip(all_droplets, ["web-1", "web-2", "db-1", "cache-10"]):
+        drop.name = name
+    manager = mock.Mock(get_all_droplets=mock.Mock(return_value=all_droplets))
+
+    found = dobackup.find_droplets("web-*, 3,re:^cache-[0-9]+$,web-1", manager)
+    assert [drop.id for drop in found] == [1, 2, 3, 4]
+    assert manager.get_all_droplets.call_count == 1
+    assert dobackup.find_droplets("web-*,nope", manager) == []
+    found = dobackup.find_droplets("re:^(web|db)-[0-9]{1,3}$,cache-10", manager)
+    assert [drop.id for drop in found] == [1, 2, 3, 4]
+    assert dobackup.find_droplets("re:^web-[0-9", manager) == []  # invalid regex
+    assert dobackup.split_droplet_strs(r"re:\{,a") == [r"re:\{", "a"]
+
+
+# Offline simulation of the droplet API, driven by a VirtualClock
+
+
+class FakeAction:
+    def __init__(self, action_id, resource_id, polls, outcome="completed"):
+        self.id = action_id
+        self.resource_id = resource_id
+        self.status = "in-progress"
+        self.polls = polls  # loads before the action finishes
+        self.outcome = outcome
+
+    def load(self):
+        self.polls -= 1
+        if self.polls <= 0:
+            self.status = self.outcome
+
+    def __str__(self):
+        return "<FakeAction: {} {}>".format(self.id, self.status)
+
+
+class FakeDroplet:
+    def __init__(self, droplet_id, status="active", snapshot_outcome="completed", flaky=0):
+        self.id = droplet_id
+        self.name = "drop-{}".format(droplet_id)
+        self.status = status
+        self.snapshot_ids = []
+        self.region = {"slug": "nyc3"}
+        self.ip_address = "10.0.0.{}".format(droplet_id)
+        self.token = "token"
+        self.actions = {}
+        self.next_status = None
+        self.snapshot_outcome = snapshot_outcome
+        self.flaky = flaky  # api errors raised before take_snapshot succeeds
+
+    def _start(self, polls, outcome="completed"):
+        action = FakeAction(len(self.actions) + 1, self.id, polls, outcome)
+        self.actions[action.id] = action
+        return {"action": {"id": action.id}}
+
+    def shutdown(self):
+        self.next_status = "off"
+        return self._start(polls=2)
+
+    def power_on(self):
+        self.next_status = "active"
+        return self._start(polls=2)
+
+    def take_snapshot(self, name, power_off=False):
+        if self.flaky:
+            self.flaky -= 1
+            raise digitalocean.baseapi.Error("flaky")
+        self.snapshot_ids.append(self.id * 100)
+        return self._start(polls=10, outcome=self.snapshot_outcome)
+
+    def get_action(self, action_id):
+        return self.actions[action_id]
+
+    def load(self):
+        if self.next_status and all(a.status != "in-progress" for a in self.actions.values()):
+            self.status = self.next_status
+            self.next_status = None
+
+    def __str__(self):
+        return "<FakeDroplet: {} {}>".format(self.id, self.name)
+
+
+@pytest.fixture
+def virtual_clock():
+    new_clock = dobackup.VirtualClock()
+    old_clock = dobackup.set_clock(new_clock)
+    yield new_clock
+    dobackup.set_clock(old_clock)
+
+
+def test_backup_state_machine_virtual_time(virtual_clock):
+    droplets = [FakeDroplet(1), FakeDroplet(2, flaky=2), FakeDroplet(3, status="off")]
+    started = time.monotonic()
+    results = dobackup.backup_droplets(droplets, False, "dobackup", False, [], 4)
+    assert all(result.ok for result in results)
+    assert [result.snapshot_id for result in results] == [100, 200, 300]
+    assert results[0].downtime > results[0].snapshot_duration > 0
+    assert results[2].downtime == 0.0  # was already off
+    assert time.monotonic() - started < 2
+    assert [drop.status for drop in droplets] == ["active", "active", "off"]
+    assert virtual_clock.sleeps.count(5) == 2  # the two retries of take_snapshot
+    assert virtual_clock.elapsed >= 100  # 10 polls of every snapshot, 10 seconds apart
+
+
+def test_backup_failed_snapshot_still_powers_up(virtual_clock):
+    droplets = [FakeDroplet(1), FakeDroplet(2, snapshot_outcome="errored")]
+    results = dobackup.backup_droplets(droplets, False, "dobackup", False, [], 4)
+    assert [result.ok for result in results] == [True, False]
+    assert [drop.status for drop in droplets] == ["active", "active"]
+
+
+def test_wait_for_action_times_out(virtual_clock):
+    action = FakeAction(1, 1, polls=1000)
+    assert dobackup.wait_for_action(action, 10) is False
+    assert virtual_clock.elapsed == 10 * 21
+
+
+def test_send_command_gives_up(virtual_clock):
+    broken = mock.Mock(load=mock.Mock(side_effect=ValueError))
+    with pytest.raises(SystemExit):
+        dobackup.send_command(5, broken, "load")
+    assert virtual_clock.sleeps == [5] * 5
+
+
+def test_virtual_clock_parallel_sleeps_overlap(virtual_clock):
+    virtual_clock.sleep(5)
+    started = []
+    all_started = threading.Barrier(3)
+
+    def sleeper():
+        started.append(virtual_clock.monotonic())
+        all_started.wait()
+        virtual_clock.sleep(10)
+
+    sleepers = [threading.Thread(target=sleeper) for i in range(3)]
+    [sleeper.start() for sleeper in sleepers]
+    [sleeper.join() for sleeper in sleepers]
+    assert started == [5, 5, 5]  # new threads start at the furthest time
+    assert virtual_clock.elapsed == 15
+    assert virtual_clock.monotonic() == 5  # this thread didn't sleep meanwhile
+
+
+def test_deadline_stops_new_droplets(virtual_clock):
+    droplets = [FakeDroplet(1), FakeDroplet(2), FakeDroplet(3)]
+    # shutting a droplet down takes 9 virtual seconds, the third would start in the last 10% of the budget.
+    # The droplets are started one after another on this thread, so their shutdowns add up
+    deadline = dobackup.Deadline(20)
+    results = dobackup.backup_droplets(droplets, False, "dobackup", False, [], 4, deadline=deadline)
+    assert [result.error for result in results] == [None, None, "skipped, deadline near"]
+    assert deadline.reached is True
+    assert droplets[2].actions == {}  # never started
+    # the ones already powered off are finished and powered back up
+    assert [drop.status for drop in droplets[:2]] == ["active", "active"]
+
+
+def test_deadline_abandons_live_waits(virtual_clock):
+    deadline = dobackup.Deadline(50)
+    results = dobackup.backup_droplets([FakeDroplet(1)], False, "dobackup", True, [], 4, deadline=deadline)
+    assert results[0].error == "snapshot failed"
+    assert deadline.reached is True
+    assert virtual_clock.elapsed <= 60
+
+
+def test_run_lock(tmp_path):
+    lock_path = dobackup.acquire_run_lock("token", "dobackup", str(tmp_path))
+    assert lock_path is not None
+    assert dobackup.acquire_run_lock("token", "dobackup", str(tmp_path)) is None
+    # other tags and tokens have their own lock
+    assert dobackup.acquire_run_lock("token", "web-servers", str(tmp_path)) is not None
+    assert dobackup.acquire_run_lock("other-token", "dobackup", str(tmp_path)) is not None
+    dobackup.release_run_lock(lock_path)
+    assert dobackup.acquire_run_lock("token", "dobackup", str(tmp_path)) is not None
+
+
+def test_run_lock_stale(tmp_path):
+    lock_path = dobackup.acquire_run_lock("token", "dobackup", str(tmp_path))
+    with open(lock_path) as lock_file:
+        lock_info = json.load(lock_file)
+    lock_info["pid"] = 2 ** 22 + 1  # above pid_max, never running
+    with open(lock_path, "w") as lock_file:
+        json.dump(lock_info, lock_file)
+    assert dobackup.acquire_run_lock("token", "dobackup", str(tmp_path)) == lock_path
+
+
+def test_run_lock_release_leaves_a_taken_over_lock(tmp_path):
+    lock_path = dobackup.acquire_run_lock("token", "dobackup", str(tmp_path))
+    # this run outlived the stale limit and another run took the lock over
+    with open(lock_path, "w") as lock_file:
+        json.dump({"pid": 1, "host": "other", "started": time.time()}, lock_file)
+    dobackup.release_run_lock(lock_path)
+    with open(lock_path) as lock_file:
+        assert json.load(lock_file)["host"] == "other"
+    assert os.listdir(str(tmp_path)) == [os.path.basename(lock_path)]
+
+
+def test_stale_lock_removal_never_removes_a_new_lock(tmp_path):
+    lock_path = str(tmp_path / "run.lock")
+    with open(lock_path, "w") as lock_file:
+        lock_file.write("new lock of another run")
+    original_link = os.link
+
+    def link(source, target):
+        with open(target, "w") as lock_file:  # yet another run creates the lock meanwhile
+            lock_file.write("newest lock")
+        original_link(source, target)
+
+    with mock.patch("os.link", link):
+        # the lock found stale was replaced by another run's before it could be moved aside
+        assert dobackup.remove_lock_if_unchanged(lock_path, "stale lock") is False
+    contents = sorted(open(str(path)).read() for path in tmp_path.iterdir())
+    assert contents == ["new lock of another run", "newest lock"]
+
+
+def test_backup_client(virtual_clock):
+    droplet = FakeDroplet(7)
+    manager = mock.Mock(get_all_droplets=mock.Mock(return_value=[droplet]))
+    with mock.patch("dobackup.dobackup.set_manager", return_value=manager):
+        client = dobackup.BackupClient(token="token")
+    result = client.live_backup("drop-7")
+    assert result.ok
+    assert result.snapshot_id == 700
+    assert result.snapshot_name.startswith("drop-7--dobackup--")
+    assert droplet.status == "active"
+    with pytest.raises(LookupError):
+        client.backup("nope")
+
+
+def test_api_counter():
+    counter = dobackup.ApiCounter()
+    counter.count("get", "https://api.digitalocean.com/v2/droplets/?tag_name=dobackup&per_page=200")
+    counter.count("GET", "https://api.digitalocean.com/v2/droplets/123/actions/456")
+    counter.count("GET", "https://api.digitalocean.com/v2/droplets/124/actions/457")
+    counter.count("POST", "https://api.digitalocean.com/v2/images/789/actions/")
+    assert counter.counts == {
+        "GET droplets": 1,
+        "GET droplets/{id}/actions/{id}": 2,
+        "POST images/{id}/actions": 1,
+    }
+    assert counter.total == 4
+
+    original_request = requests.Session.request
+    counter.install()
+    with mock.patch("requests.adapters.HTTPAdapter.send", side_effect=requests.exceptions.ConnectionError):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            requests.get("https://api.digitalocean.com/v2/account")
+    counter.uninstall()
+    assert requests.Session.request is original_request
+    assert counter.counts["GET account"] == 1
+
+
+def test_backup_prunes_after_each_new_snapshot(virtual_clock):
+    droplets = [FakeDroplet(1), FakeDroplet(2, snapshot_outcome="errored")]
+    old = {str(drop.id): [mock.Mock(id=str(drop.id) + "-old", resource_id=str(drop.id))] for drop in droplets}
+    delete_snapshot = mock.Mock(return_value=True)
+    with mock.patch("dobackup.dobackup.delete_snapshot", delete_snapshot):
+        results = dobackup.backup_droplets(droplets, False, "dobackup", False, [], 4, prune=old)
+    assert results[0].pruned == {"1-old": True}
+    # the droplet whose new backup failed keeps its old ones
+    assert results[1].pruned == {}
+    assert list(old) == ["2"]
+    delete_snapshot.assert_called_once()
+
+
+def test_live_backup_hooks(virtual_clock, tmp_path):
+    droplets = [FakeDroplet(1), FakeDroplet(2)]
+    hooks = dobackup.Hooks(
+        pre="test {id} != 2 && echo $DOBACKUP_HOOK {name} >> " + str(tmp_path / "{id}.log"),
+        post="echo $DOBACKUP_HOOK {ip} >> " + str(tmp_path / "{id}.log"),
+        timeout=5,
+    )
+    results = dobackup.backup_droplets(droplets, False, "dobackup", True, [], 4, hooks=hooks)
+    assert [result.error for result in results] == [None, "pre-snapshot hook failed"]
+    assert (tmp_path / "1.log").read_text() == "pre-snapshot drop-1\npost-snapshot 10.0.0.1\n"
+    # the failed pre hook is undone, and the droplet isn't snapshotted
+    assert (tmp_path / "2.log").read_text() == "post-snapshot 10.0.0.2\n"
+    assert droplets[1].actions == {}
+
+
+def test_hook_over_ssh_stand_in_and_timeout():
+    droplet = FakeDroplet(3)
+    hooks = dobackup.Hooks(ssh_user="root", ssh_command="sh -c {command} {target}", timeout=5)
+    assert dobackup.run_hook('test "$0" = root@10.0.0.3', droplet, "pre-snapshot", hooks)[0] is True
+    assert dobackup.run_hook("exit 1", droplet, "pre-snapshot", hooks)[0] is False
+    assert dobackup.run_hook("sleep 5", droplet, "pre-snapshot", hooks._replace(timeout=0.1))[0] is False
+
+
+def test_hook_timeout_kills_what_the_hook_started(tmp_path):
+    droplet = FakeDroplet(5)
+    hooks = dobackup.Hooks(timeout=0.5)
+    pid_path = tmp_path / "pid"
+    # the shell runs sleep as its own child, which keeps the output pipe open
+    command = "sleep 30 & echo $! > " + str(pid_path) + "; wait"
+    started = time.monotonic()
+    assert dobackup.run_hook(command, droplet, "pre-snapshot", hooks)[0] is False
+    assert time.monotonic() - started < 10
+    stat_path = "/proc/{}/stat".format(int(pid_path.read_text()))
+    # killed, though maybe left a zombie until it is reaped
+    assert not os.path.exists(stat_path) or open(stat_path).read().split(") ")[1][0] == "Z"
+
+
+def test_shard_owner_is_balanced_and_stable():
+    owners = [dobackup.shard_owner(droplet_id, 4) for droplet_id in range(1000)]
+    assert owners == [dobackup.shard_owner(droplet_id, 4) for droplet_id in range(1000)]
+    assert all(150 < owners.count(index) < 350 for index in range(4))
+    # going to 5 shards only moves the droplets the new shard takes
+    moved = [droplet_id for droplet_id in range(1000) if dobackup.shard_owner(droplet_id, 5) != owners[droplet_id]]
+    assert all(dobackup.shard_owner(droplet_id, 5) == 4 for droplet_id in moved)
+    assert len(moved) < 350
+
+
+def test_shards_claim_and_take_over(tmp_path):
+    droplets = [FakeDroplet(i) for i in range(40)]
+    first = dobackup.Shard(0, 2, str(tmp_path), "run", takeover_after=600)
+    second = dobackup.Shard(1, 2, str(tmp_path), "run", takeover_after=600)
+    first.start()
+    second.start()
+    mine = first.take(droplets)
+    assert mine and all(first.owns(droplet) for droplet in mine)
+    # the first shard claims two droplets, finishes one and fails before starting the rest
+    assert first.claim(mine[0]) and first.claim(mine[1])
+    first.done(mine[0].id)
+    assert second.take_over(droplets) == []  # first is still running
+    first.stop()
+    orphans = second.take_over(droplets)
+    assert mine[0] not in orphans and mine[1] in orphans
+    assert len(orphans) == len(mine) - 1
+    # the claimed but unfinished droplet is claimed once more, by only one shard taking over
+    third = dobackup.Shard(1, 2, str(tmp_path), "run")
+    assert second.claim(mine[1]) and not third.claim(mine[1])
+    assert not second.claim(mine[0])  # done
+    second.stop()
+
+
+def test_backup_skips_droplets_claimed_elsewhere(virtual_clock):
+    droplets = [FakeDroplet(1), FakeDroplet(2)]
+    results = dobackup.backup_droplets(droplets, False, "dobackup", True, [], 4, claim=lambda droplet: droplet.id == 1)
+    assert [(result.droplet_id, result.ok) for result in results] == [(1, True)]
+    assert droplets[1].actions == {}
+
+
+def test_profile_trace_timeline(virtual_clock, tmp_path):
+    droplets = [FakeDroplet(1), FakeDroplet(2, status="off")]
+    trace_profiler = dobackup.TraceProfiler()
+    old_profiler = dobackup.set_profiler(trace_profiler)
+    try:
+        old_backup = mock.Mock(id="9", resource_id=1, destroy=mock.Mock(return_value=True))
+        results = dobackup.backup_droplets(droplets, False, "dobackup", False, [], 2, prune={"1": [old_backup]})
+    finally:
+        dobackup.set_profiler(old_profiler)
+    assert all(result.ok for result in results)
+    trace_profiler.write(str(tmp_path / "trace.json"))
+    with open(str(tmp_path / "trace.json")) as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    assert {"api", "wait", "sleep", "phase"} <= {span["cat"] for span in spans}
+    # every api request made for a droplet, whichever thread made it, is attributed to it
+    names = {span["name"] for span in spans if span["args"].get("droplet_id") == 1}
+    assert {"shutdown", "snapshot", "powerup", "delete", "FakeDroplet.take_snapshot"} <= names
+    assert all(span["dur"] >= 0 for span in spans)
+    threads = [event["args"]["name"] for event in events if event["name"] == "thread_name"]
+    assert any(name.startswith("wait") for name in threads) and any(name.startswith("stage") for name in threads)
+    assert trace_profiler.totals()["sleep"][1] > 0
+
+
+def fake_snapshot(snap_id, name, droplet_id, created_at, size=1.5):
+    snap = mock.Mock(id=str(snap_id), resource_id=str(droplet_id), resource_type="droplet", regions=["nyc3"])
+    snap.name, snap.created_at, snap.size_gigabytes = name, created_at, size
+    return snap
+
+
+def test_catalog_syncs_incrementally_and_answers_queries(virtual_clock, tmp_path):
+    virtual_clock.start = datetime.datetime(2020, 1, 10)
+    catalog = dobackup.Catalog(path=str(tmp_path / "catalog.sqlite"))
+    web = mock.Mock(id=1, tags=["dobackup"])
+    db = mock.Mock(id=2, tags=["dobackup"])
+    web.name, db.name = "web", "db"
+    catalog.sync_droplets([web, db])
+    listing = [
+        fake_snapshot(11, "web--dobackup--2020-01-01 01:00:00", 1, "2020-01-01T01:00:00Z"),
+        fake_snapshot(12, "web--dobackup-keep--2020-01-09 01:00:00", 1, "2020-01-09T01:00:00Z", 2.0),
+        fake_snapshot(21, "db--dobackup--2020-01-02 01:00:00", 2, "2020-01-02T01:00:00Z"),
+        fake_snapshot(31, "manual", 3, "2020-01-03T01:00:00Z", 10.0),
+    ]
+    assert catalog.sync_snapshots(listing) == (4, 0, 0)
+    # nothing changed, nothing written, then one resized and one deleted outside dobackup
+    assert catalog.sync_snapshots(listing) == (0, 0, 0)
+    listing[3].size_gigabytes = 12.0
+    assert catalog.sync_snapshots(listing[1:]) == (0, 1, 1)
+
+    assert [(row[1], row[2]) for row in catalog.latest_backups("dobackup")] == [("db", "21"), ("web", "12")]
+    assert [row[1] for row in catalog.not_backed_up_in("dobackup", 48)] == ["db"]
+    catalog.add_backup(db, 22, "db--dobackup--2020-01-10 00:00:00")
+    assert catalog.not_backed_up_in("dobackup", 48) == []
+    assert catalog.storage_per_tag() == [(None, 1, 12.0), ("dobackup", 3, 3.5)]
+    catalog.remove_snapshot("22")
+    assert [row[2] for row in catalog.latest_backups("dobackup")] == ["21", "12"]
+    catalog.close()
+
+
+def test_backup_tag_from_name():
+    assert dobackup.backup_tag("web--dobackup--2020-01-01 01:00:00") == ("dobackup", 0)
+    assert dobackup.backup_tag("web-1--db-servers-keep--2020-01-01 01:00:00") == ("db-servers", 1)
+    assert dobackup.backup_tag("web-1 2020-01-01") == (None, 0)
+
+
+def test_live_backup_post_hook_runs_when_snapshot_gives_up(virtual_clock, tmp_path):
+    droplets = [FakeDroplet(1), FakeDroplet(2, flaky=10)]  # take_snapshot of droplet 2 fails every retry
+    hooks = dobackup.Hooks(
+        pre="echo $DOBACKUP_HOOK >> " + str(tmp_path / "{id}.log"),
+        post="echo $DOBACKUP_HOOK >> " + str(tmp_path / "{id}.log"),
+        timeout=5,
+    )
+    with pytest.raises(SystemExit):
+        dobackup.backup_droplets(droplets, False, "dobackup", True, [], 4, hooks=hooks)
+    for droplet_id in (1, 2):
+        assert (tmp_path / "{}.log".format(droplet_id)).read_text() == "pre-snapshot\npost-snapshot\n"
+
+
+def test_hook_leaves_other_braces_alone(tmp_path):
+    droplet = FakeDroplet(4)
+    hooks = dobackup.Hooks(timeout=5)
+    command = "echo {name} x | awk '{print $2}' > " + str(tmp_path / "out") + ' && test "${HOME}" = "$HOME"'
+    assert dobackup.run_hook(command, droplet, "pre-snapshot", hooks)[0] is True
+    assert (tmp_path / "out").read_text() == "x\n"
+
+
+def test_not_backed_up_in_counts_the_backups_just_taken(virtual_clock, tmp_path):
+    droplets = [FakeDroplet(1), FakeDroplet(2)]
+    for droplet in droplets:
+        droplet.tags = ["dobackup"]
+    droplets[1].take_snapshot = lambda name, power_off=False: droplets[1]._start(polls=10)  # its id is never found
+    manager = mock.Mock()
+    manager.get_all_droplets.return_value = droplets
+    manager.get_droplet_snapshots.return_value = []
+    real_catalog = dobackup.Catalog
+    with mock.patch.multiple(
+        "dobackup.dobackup",
+        get_token=mock.Mock(return_value="token"),
+        set_manager=mock.Mock(return_value=manager),
+        acquire_run_lock=mock.Mock(return_value="lock"),
+        release_run_lock=mock.DEFAULT,
+        shards_apart=mock.Mock(return_value=True),
+        Catalog=lambda do_token: real_catalog(path=str(tmp_path / "catalog.sqlite")),
+    ):
+        args = [0, False, False, False, False, False, False, None, None, None, "dobackup", None, None, None, False]
+        # --not-backed-up-in 48, then --live-backup-all --catalog --not-backed-up-in 48
+        assert dobackup.run(*args, None, False, None, None, None, None, False, not_backed_up_in=48) == 1
+        live_backup_all = dict(use_catalog=True, not_backed_up_in=48)
+        assert dobackup.run(*args, None, True, None, None, None, None, False, **live_backup_all) == 0
+    assert all(droplet.actions for droplet in droplets)
+
+
+def test_new_snapshot_lookup_waits_for_lagging_snapshot_ids(virtual_clock):
+    droplet = FakeDroplet(8)
+    lagging_load = droplet.load
+
+    def load():
+        # the new snapshot only shows up in snapshot_ids on the second load after it completed
+        lagging_load()
+        droplet.loads = getattr(droplet, "loads", 0) + 1
+        if droplet.loads == 2:
+            droplet.snapshot_ids.append(800)
+
+    droplet.take_snapshot = lambda name, power_off=False: droplet._start(polls=10)  # not in snapshot_ids yet
+    droplet.load = load
+    results = dobackup.backup_droplets([droplet], False, "dobackup", True, [], 4)
+    assert results[0].ok and results[0].snapshot_id == 800
+    # never showing up is only an error when the snapshot has to be transferred
+    droplet.load = lagging_load
+    results = dobackup.backup_droplets([droplet], False, "dobackup", True, [], 4)
+    assert results[0].ok and results[0].snapshot_id is None
+    with mock.patch("dobackup.dobackup.transfer_snapshot") as transfer_snapshot:
+        results = dobackup.backup_droplets([droplet], False, "dobackup", True, ["ams3"], 4)
+    assert results[0].error == "new snapshot not found"
+    assert not transfer_snapshot.called
+
+
+def test_backup_results_do_not_share_dicts(virtual_clock):
+    deadline = dobackup.Deadline(1)
+    virtual_clock.sleep(1)  # already reached, both droplets are skipped
+    results = dobackup.backup_droplets([FakeDroplet(1), FakeDroplet(2)], False, "dobackup", True, [], 4, deadline)
+    assert [result.transfers for result in results] == [{}, {}]
+    assert results[0].transfers is not results[1].transfers and results[0].pruned is not results[1].pruned
+    assert dobackup.BackupResult(1, "web").transfers is None
+
+
+def test_run_lock_stale_taken_over_once(tmp_path):
+    lock_path = dobackup.acquire_run_lock("token", "dobackup", str(tmp_path))
+    with open(lock_path, "w") as lock_file:
+        json.dump({"pid": 2 ** 22 + 1, "host": dobackup.socket.gethostname(), "started": time.time()}, lock_file)
+    real_lock_is_stale = dobackup.lock_is_stale
+    other_run = []
+
+    def lock_is_stale(path, content):
+        # another run finds the same lock stale and takes it over first
+        if not other_run:
+            other_run.append(None)
+            other_run[0] = dobackup.acquire_run_lock("token", "dobackup", str(tmp_path))
+        return real_lock_is_stale(path, content)
+
+    with mock.patch("dobackup.dobackup.lock_is_stale", side_effect=lock_is_stale):
+        assert dobackup.acquire_run_lock("token", "dobackup", str(tmp_path)) is None
+    assert other_run == [lock_path]
+    with open(lock_path) as lock_file:
+        assert json.load(lock_file)["pid"] == dobackup.os.getpid()
+    assert [path.name for path in tmp_path.iterdir()] == [dobackup.os.path.basename(lock_path)]
+
+
+def test_sharded_and_plain_runs_exclude_each_other(tmp_path):
+    shard = dobackup.Shard(1, 2)
+    shard_lock = dobackup.acquire_run_lock("token", "dobackup-shard-1", str(tmp_path))
+    assert dobackup.shards_apart("token", "dobackup", shard, str(tmp_path))
+    assert dobackup.acquire_run_lock("token", "dobackup-shard-0", str(tmp_path)) is not None  # other shards are fine
+    plain_lock = dobackup.acquire_run_lock("token", "dobackup", str(tmp_path))
+    assert not dobackup.shards_apart("token", "dobackup", None, str(tmp_path))
+    assert not dobackup.shards_apart("token", "dobackup", shard, str(tmp_path))
+    dobackup.release_run_lock(plain_lock)
+    assert dobackup.shards_apart("token", "dobackup", shard, str(tmp_path))
+    assert dobackup.shards_apart("token", "web", None, str(tmp_path))
+    dobackup.release_run_lock(shard_lock)
+
+
+def test_backup_all_requests_grow_linearly(virtual_clock):
+    real_send_command = dobackup.send_command
+    for droplet_count in (3, 6):
+        droplets = [FakeDroplet(i) for i in range(1, droplet_count + 1)]
+        manager = mock.Mock(get_all_droplets=mock.Mock(return_value=droplets))
+        sent = []
+
+        def send_command(retries, obj, method, *args, **kwargs):
+            sent.append((type(obj).__name__, method))
+            return real_send_command(retries, obj, method, *args, **kwargs)
+
+        with mock.patch.multiple(
+            "dobackup.dobackup",
+            get_token=mock.Mock(return_value="token"),
+            set_manager=mock.Mock(return_value=manager),
+            acquire_run_lock=mock.Mock(return_value="lock"),
+            release_run_lock=mock.DEFAULT,
+            shards_apart=mock.Mock(return_value=True),
+            send_command=send_command,
+        ):
+            # --backup-all
+            args = [0, False, False, False, False, False, False, None, None, None, "dobackup", None, None, None, True]
+            assert dobackup.run(*args, None, False, None, None, None, None, False) == 0
+        # one listing, then per droplet: shutdown, take_snapshot, power_on, their 3 get_action and one load,
+        # the polling of the actions aside. Nothing is fetched again one by one
+        assert sent.count(("Mock", "get_all_droplets")) == 1
+        assert not [method for kind, method in sent if method in ("get_droplet", "get_object")]
+        assert len(sent) <= 1 + 7 * droplet_count